@@ -0,0 +1,14 @@
+"""Reconstrói o dataset Parquet (ARQUIVO_DIR) a partir da notas_fiscais_v7.
+
+Necessário ao ligar o arquivo numa base que já tem notas, ou quando ele sai de sincronia com o banco
+(migração, falha ao gravar o dataset): até lá os relatórios continuam lendo do banco.
+
+Uso: ARQUIVO_DIR=/dados/nfe python arquivar.py
+"""
+from main import ARQUIVO_DIR, reconstruir_arquivo
+
+if __name__ == "__main__":
+    if not ARQUIVO_DIR:
+        print("ARQUIVO_DIR não definido, nada a fazer.")
+    else:
+        print(f"Concluído: {reconstruir_arquivo()} itens gravados em {ARQUIVO_DIR}.")
@@ -0,0 +1,311 @@
+"""Benchmark da importação e dos relatórios sobre um corpus sintético (corpus.py).
+
+Etapas:
+  extrator    compara main.parse_xml com o extrator antigo baseado em find() (mesmas linhas, tempo de cada um)
+  parse       notas/s e itens/s do parse_xml, em série e no pool de processos
+  carga       linhas/s gravadas no banco (gravar_documentos com as notas já extraídas)
+  importacao  notas/s e linhas/s de ponta a ponta (importar_zips sobre os ZIPs do corpus)
+  relatorio   tempo e pico de memória (RSS) do gerar por formato, cada um num processo novo
+
+Roda numa pasta de trabalho própria (--dir, padrão: pasta temporária) com um SQLite próprio; para medir
+outro banco passe --db (as tabelas de notas são esvaziadas, use um banco descartável). O resultado vai em
+JSON (--saida) e pode ser comparado com uma execução anterior (--comparar).
+
+Uso: python benchmark.py [etapas...] [--notas 2000] [--itens 1-30] [--saida resultado.json] [--comparar anterior.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+from corpus import gerar_corpus, gravar_zips, GRUPOS_ICMS, _intervalo
+
+ETAPAS = ['extrator', 'parse', 'carga', 'importacao', 'relatorio']
+
+# --- EXTRATOR ANTIGO (referência, só para comparação) ---
+ns_map = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
+
+def get_val(node, path, type_fn=str):
+    if node is None: return type_fn(0) if type_fn in [float, int] else ""
+    try:
+        r = node.find(path, ns_map)
+        if r is None: r = node.find(path.replace('nfe:', ''))
+        if r is not None and r.text:
+            return type_fn(r.text.replace(',', '.'))
+    except: pass
+    return type_fn(0) if type_fn in [float, int] else ""
+
+def parse_xml_find(dados):
+    try:
+        root = ET.fromstring(dados)
+        if 'nfeProc' in root.tag: inf = root.find('.//nfe:infNFe', ns_map)
+        else: inf = root.find('nfe:infNFe', ns_map)
+        if inf is None: return []
+
+        ide = inf.find('nfe:ide', ns_map)
+        emit = inf.find('nfe:emit', ns_map)
+        dest = inf.find('nfe:dest', ns_map)
+        total = inf.find('.//nfe:ICMSTot', ns_map)
+        prot = root.find('.//nfe:infProt', ns_map)
+        chave = get_val(prot, 'nfe:chNFe') or inf.attrib.get('Id', '')[3:]
+
+        dt_str = get_val(ide, 'nfe:dhEmi') or get_val(ide, 'nfe:dEmi')
+        dt = datetime.now()
+        if len(dt_str) >= 10: dt = datetime.strptime(dt_str[:10], '%Y-%m-%d')
+
+        itens_db = []
+        for i, det in enumerate(inf.findall('nfe:det', ns_map)):
+            prod = det.find('nfe:prod', ns_map)
+            imposto = det.find('nfe:imposto', ns_map)
+            cst = get_val(imposto, './/nfe:CST')
+            if not cst: cst = get_val(imposto, './/nfe:CSOSN')
+            row = {
+                'Mês': str(dt.month).zfill(2),
+                'Ano': str(dt.year),
+                'Chave Acesso NFe': chave,
+                'Inscrição Destinatário': get_val(dest, 'nfe:IE'),
+                'Inscrição Emitente': get_val(emit, 'nfe:IE'),
+                'Razão Social Emitente': get_val(emit, 'nfe:xNome'),
+                'Cnpj Emitente': get_val(emit, 'nfe:CNPJ'),
+                'UF Emitente': get_val(emit, 'nfe:enderEmit/nfe:UF'),
+                'Nr NFe': get_val(ide, 'nfe:nNF'),
+                'Série': get_val(ide, 'nfe:serie'),
+                'Data NFe': dt.strftime('%d/%m/%Y'),
+                'BC ICMS Total': get_val(total, 'nfe:vBC', float),
+                'ICMS Total': get_val(total, 'nfe:vICMS', float),
+                'BC ST Total': get_val(total, 'nfe:vBCST', float),
+                'ICMS ST Total': get_val(total, 'nfe:vST', float),
+                'Desc Total': get_val(total, 'nfe:vDesc', float),
+                'IPI Total': get_val(total, 'nfe:vIPI', float),
+                'Total Produtos': get_val(total, 'nfe:vProd', float),
+                'Total NFe': get_val(total, 'nfe:vNF', float),
+                'Descrição Produto NFe': get_val(prod, 'nfe:xProd'),
+                'NCM na NFe': get_val(prod, 'nfe:NCM'),
+                'CST': cst,
+                'CFOP NFe': get_val(prod, 'nfe:CFOP'),
+                'Qtde': get_val(prod, 'nfe:qCom', float),
+                'Unid': get_val(prod, 'nfe:uCom'),
+                'Vr Unit': get_val(prod, 'nfe:vUnCom', float),
+                'Vr Total': get_val(prod, 'nfe:vProd', float),
+                'Desconto Item': get_val(prod, 'nfe:vDesc', float),
+                'Base de Cálculo ICMS': get_val(imposto, './/nfe:ICMS//nfe:vBC', float),
+                'Aliq ICMS': get_val(imposto, './/nfe:ICMS//nfe:pICMS', float),
+                'Vr ICMS': get_val(imposto, './/nfe:ICMS//nfe:vICMS', float),
+                'Aliq IPI': get_val(imposto, './/nfe:IPI//nfe:pIPI', float),
+                'Vr IPI': get_val(imposto, './/nfe:IPI//nfe:vIPI', float)
+            }
+            itens_db.append((f"{chave}-{i+1}", chave, str(dt.year), str(dt.month).zfill(2),
+                             get_val(emit, 'nfe:CNPJ'), get_val(dest, 'nfe:CNPJ'), str(row)))
+        return itens_db
+    except: return []
+
+def como_legado(linha):
+    # Converte a tupla tipada do parser atual no formato antigo (dados_json) para comparar
+    from main import CAMPOS_RELATORIO, COLUNAS_NFE
+    d = dict(zip(COLUNAS_NFE, linha))
+    row = {rotulo: d[c] for c, rotulo in CAMPOS_RELATORIO}
+    row['Data NFe'] = d['data_nfe'].strftime('%d/%m/%Y')
+    return (d['chave_item'], d['chave_acesso'], d['ano'], d['mes'], d['cnpj_emitente'], d['cnpj_destinatario'], str(row))
+
+# --- MEDIÇÃO ---
+def medir(fn, *args):
+    ini = time.perf_counter()
+    r = fn(*args)
+    return time.perf_counter() - ini, r
+
+def rss_pico_mb():
+    # ru_maxrss vem em KB no Linux e em bytes no macOS
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(pico / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def por_segundo(qtd, t):
+    return round(qtd / t, 1) if t else None
+
+def limpar_banco():
+    from main import SessionLocal, NFe, Documento, HashDocumento, ResumoNota, ResumoMensal, Faceta, CacheRelatorio
+    from sqlalchemy import delete
+    with SessionLocal() as sess:
+        for modelo in (NFe, Documento, HashDocumento, ResumoNota, ResumoMensal, Faceta, CacheRelatorio):
+            sess.execute(delete(modelo))
+        sess.commit()
+
+# --- ETAPAS ---
+def etapa_extrator(docs, args):
+    from main import parse_xml
+    amostra = docs[:200]
+    # As duas implementações precisam gerar exatamente as mesmas linhas
+    for _, d in amostra:
+        assert [como_legado(l) for l in parse_xml(d)] == parse_xml_find(d), "extratores divergem"
+    t_find, _ = medir(lambda: [parse_xml_find(d) for _, d in docs])
+    t_iter, _ = medir(lambda: [parse_xml(d) for _, d in docs])
+    return {'find_notas_s': por_segundo(len(docs), t_find), 'iterparse_notas_s': por_segundo(len(docs), t_iter),
+            'ganho': round(t_find / t_iter, 2)}
+
+def etapa_parse(docs, args):
+    import hashlib
+    import tracemalloc
+    from main import extrair_nfe, parse_lote, get_pool, PARSE_BATCH, PARSE_WORKERS
+    t, notas = medir(lambda: [extrair_nfe(d) for _, d in docs])
+    itens = sum(len(n.itens) for n in notas)
+    # Memória ocupada pelas notas extraídas (o que fica em buffer até a gravação), por item
+    del notas
+    tracemalloc.start()
+    notas = [extrair_nfe(d) for _, d in docs]
+    retido = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del notas
+    lotes = [[(nome, hashlib.sha256(d).hexdigest(), d) for nome, d in docs[i:i + PARSE_BATCH]]
+             for i in range(0, len(docs), PARSE_BATCH)]
+    pool = get_pool()
+    list(pool.map(parse_lote, lotes[:PARSE_WORKERS]))  # aquece os processos antes de medir
+    t_pool, _ = medir(lambda: list(pool.map(parse_lote, lotes)))
+    return {'notas': len(docs), 'itens': itens, 'bytes': sum(len(d) for _, d in docs),
+            'serie_notas_s': por_segundo(len(docs), t), 'serie_itens_s': por_segundo(itens, t),
+            'bytes_item': round(retido / itens) if itens else None,
+            'pool_workers': PARSE_WORKERS,
+            'pool_notas_s': por_segundo(len(docs), t_pool), 'pool_itens_s': por_segundo(itens, t_pool)}
+
+def etapa_carga(docs, args):
+    import hashlib
+    from main import SessionLocal, extrair_nfe, gravar_documentos, DB_BATCH_SIZE, COPY_MIN_ROWS, I_CAB
+    limpar_banco()
+    notas = {}
+    for _, d in docs:
+        nota = extrair_nfe(d)
+        if nota and nota.itens: notas[nota.cab[I_CAB['chave_acesso']]] = (hashlib.sha256(d).hexdigest(), nota)
+    total = sum(len(n.itens) for _, n in notas.values())
+    stats = {'itens': 0, 'novos': 0, 'atualizados': 0}
+    usar_copy = total >= COPY_MIN_ROWS
+
+    def gravar():
+        # Mesmo fluxo da importação: descarrega quando o buffer passa de DB_BATCH_SIZE linhas
+        with SessionLocal() as sess:
+            buffer, n = {}, 0
+            for chave, doc in notas.items():
+                buffer[chave] = doc
+                n += len(doc[1].itens)
+                if n >= DB_BATCH_SIZE:
+                    gravar_documentos(sess, buffer, stats, usar_copy)
+                    buffer, n = {}, 0
+            if buffer: gravar_documentos(sess, buffer, stats, usar_copy)
+    t, _ = medir(gravar)
+    return {'notas': len(notas), 'linhas': total, 'copy': usar_copy, 'segundos': round(t, 3),
+            'linhas_s': por_segundo(total, t), 'notas_s': por_segundo(len(notas), t)}
+
+def etapa_importacao(docs, args):
+    from main import importar_zips
+    limpar_banco()
+    zips = gravar_zips(os.path.join(args.dir, 'corpus'), docs, args.zip_mb)
+    tamanho = sum(os.path.getsize(c) for c in zips)
+
+    def importar():
+        fontes = [open(c, 'rb') for c in zips]
+        try: return importar_zips(fontes)
+        finally:
+            for f in fontes: f.close()
+    t, stats = medir(importar)
+    return {'zips': len(zips), 'mb_zip': round(tamanho / 1048576, 2), 'arquivos': stats['arquivos'],
+            'itens': stats['itens'], 'segundos': round(t, 3), 'notas_s': por_segundo(stats['arquivos'], t),
+            'linhas_s': por_segundo(stats['itens'], t), 'mb_s': por_segundo(tamanho / 1048576, t),
+            'etapas': {k: round(v, 3) for k, v in stats['tempos'].items()}}
+
+def _relatorio_isolado(formato, fila):
+    # Roda num processo novo para o pico de RSS ser só o do relatório
+    from main import SessionLocal, NFe, exportar, REPORTS_DIR
+    from sqlalchemy import select
+    with SessionLocal() as sess:
+        anos = sorted(a for (a,) in sess.execute(select(NFe.ano).distinct()))
+    rss_ini = rss_pico_mb()
+    t, filename = medir(exportar, {'anos': anos}, formato)
+    tamanho = os.path.getsize(os.path.join(REPORTS_DIR, filename)) if filename else 0
+    fila.put({'segundos': round(t, 3), 'rss_inicial_mb': rss_ini, 'rss_pico_mb': rss_pico_mb(),
+              'mb_arquivo': round(tamanho / 1048576, 2)})
+
+def etapa_relatorio(docs, args):
+    from main import SessionLocal, NFe
+    from sqlalchemy import select, func
+    with SessionLocal() as sess:
+        linhas = sess.scalar(select(func.count()).select_from(NFe))
+    if not linhas:
+        linhas = etapa_carga(docs, args)['linhas']
+    ctx = multiprocessing.get_context('spawn')
+    r = {'linhas': linhas}
+    for formato in args.formatos:
+        fila = ctx.Queue()
+        p = ctx.Process(target=_relatorio_isolado, args=(formato, fila))
+        p.start()
+        res = fila.get()
+        p.join()
+        res['linhas_s'] = por_segundo(linhas, res['segundos'])
+        r[formato] = res
+    return r
+
+# --- RESULTADOS ---
+def ambiente():
+    try: commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError: commit = ''
+    return {'data': datetime.now().isoformat(timespec='seconds'), 'commit': commit, 'python': platform.python_version(),
+            'plataforma': platform.platform(), 'cpus': os.cpu_count()}
+
+def achatar(d, prefixo=''):
+    for k, v in d.items():
+        if isinstance(v, dict): yield from achatar(v, f"{prefixo}{k}.")
+        elif isinstance(v, (int, float)) and not isinstance(v, bool): yield f"{prefixo}{k}", v
+
+def comparar(atual, anterior):
+    antes = dict(achatar(anterior['resultados']))
+    for k, v in achatar(atual['resultados']):
+        if antes.get(k):
+            print(f"  {k:<40} {antes[k]:>14,.2f} -> {v:>14,.2f}  ({v / antes[k]:.2f}x)")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark de extração, carga e relatórios.")
+    ap.add_argument("etapas", nargs="*", default=ETAPAS, help=f"etapas a rodar ({', '.join(ETAPAS)})")
+    ap.add_argument("--notas", type=int, default=2000)
+    ap.add_argument("--itens", type=_intervalo, default=(1, 30), help="itens por nota, ex.: 1-30")
+    ap.add_argument("--grupos", default=','.join(GRUPOS_ICMS))
+    ap.add_argument("--zip-mb", type=float, default=50)
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--formatos", default="xlsx,csv,parquet", type=lambda s: s.split(','))
+    ap.add_argument("--dir", help="pasta de trabalho (banco, ZIPs e relatórios); padrão: temporária")
+    ap.add_argument("--db", help="DATABASE_URL a usar; padrão: SQLite na pasta de trabalho")
+    ap.add_argument("--saida", help="grava o resultado neste JSON")
+    ap.add_argument("--comparar", help="JSON de uma execução anterior para comparar")
+    args = ap.parse_args()
+    if set(args.etapas) - set(ETAPAS): ap.error(f"etapas válidas: {', '.join(ETAPAS)}")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    saida = os.path.abspath(args.saida) if args.saida else None
+    anterior = json.load(open(args.comparar, encoding='utf-8')) if args.comparar else None
+    args.dir = os.path.abspath(args.dir or tempfile.mkdtemp(prefix='bench_nfe_'))
+    os.makedirs(args.dir, exist_ok=True)
+    os.chdir(args.dir)  # main cria banco e pastas relativos à pasta atual
+    os.environ['DATABASE_URL'] = args.db or 'sqlite:///./bench.db'
+
+    docs = list(gerar_corpus(args.notas, args.itens, args.grupos.split(','), seed=args.seed))
+    resultado = {'ambiente': ambiente(),
+                 'config': {'notas': args.notas, 'itens': list(args.itens), 'grupos': args.grupos, 'seed': args.seed,
+                            'zip_mb': args.zip_mb, 'banco': os.environ['DATABASE_URL'].split(':')[0]},
+                 'resultados': {}}
+    etapas = {'extrator': etapa_extrator, 'parse': etapa_parse, 'carga': etapa_carga,
+              'importacao': etapa_importacao, 'relatorio': etapa_relatorio}
+    for nome in [e for e in ETAPAS if e in args.etapas]:
+        print(f"{nome}...", flush=True)
+        resultado['resultados'][nome] = etapas[nome](docs, args)
+        print(f"  {json.dumps(resultado['resultados'][nome], ensure_ascii=False)}", flush=True)
+
+    if anterior:
+        print(f"comparado com {args.comparar} ({anterior['ambiente'].get('commit')}):")
+        comparar(resultado, anterior)
+    if saida:
+        with open(saida, 'w', encoding='utf-8') as f: json.dump(resultado, f, ensure_ascii=False, indent=2)
+        print(f"resultado gravado em {saida}")
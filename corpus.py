@@ -0,0 +1,163 @@
+"""Gerador de corpus sintético de NF-e para testes de carga e benchmark.
+
+Gera XMLs de NF-e modelo 55 (nfeProc com protocolo, ou NFe sem protocolo) com chave de acesso
+válida, itens com grupos de ICMS variados (ICMS00/10/60 e Simples Nacional), IPI opcional,
+PIS/COFINS e totais coerentes, empacotados em ZIPs de tamanho configurável.
+
+Uso: python corpus.py pasta_saida [--notas 1000] [--itens 1-30] [--zip-mb 50] [--grupos ICMS00,ICMS60] [--seed 42]
+"""
+import argparse
+import os
+import random
+import zipfile
+from datetime import date
+
+NS = "http://www.portalfiscal.inf.br/nfe"
+GRUPOS_ICMS = ['ICMS00', 'ICMS10', 'ICMS60', 'CSOSN101', 'CSOSN102', 'CSOSN500']
+UFS = {'SP': '35', 'RJ': '33', 'MG': '31', 'PR': '41', 'RS': '43', 'SC': '42', 'BA': '29', 'GO': '52'}
+PRODUTOS = ['Parafuso sextavado', 'Cabo flexível 2,5mm', 'Notebook', 'Monitor LED', 'Teclado USB', 'Cimento CP-II',
+            'Óleo lubrificante', 'Papel A4', 'Tinta acrílica', 'Luva nitrílica', 'Café torrado', 'Arroz tipo 1']
+NCMS = ['73181500', '85444900', '84713012', '85285200', '84716052', '25232910', '27101932', '48025610']
+UNIDADES = ['UN', 'CX', 'KG', 'PC', 'M', 'LT']
+
+def _dv_mod11(base):
+    pesos = [2, 3, 4, 5, 6, 7, 8, 9]
+    soma = sum(int(d) * pesos[i % 8] for i, d in enumerate(reversed(base)))
+    dv = 11 - soma % 11
+    return '0' if dv >= 10 else str(dv)
+
+def cnpj(rnd):
+    base = ''.join(str(rnd.randint(0, 9)) for _ in range(8)) + '0001'
+    for pesos in ([5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2], [6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2]):
+        r = sum(int(d) * p for d, p in zip(base, pesos)) % 11
+        base += '0' if r < 2 else str(11 - r)
+    return base
+
+def chave_acesso(uf, dt, cnpj_emit, serie, nnf, cnf):
+    base = f"{UFS[uf]}{dt:%y%m}{cnpj_emit}55{serie:03d}{nnf:09d}1{cnf:08d}"
+    return base + _dv_mod11(base)
+
+def _icms(grupo, v):
+    if grupo == 'ICMS00':
+        return (f'<ICMS><ICMS00><orig>0</orig><CST>00</CST><modBC>3</modBC><vBC>{v:.2f}</vBC>'
+                f'<pICMS>18.00</pICMS><vICMS>{v * 0.18:.2f}</vICMS></ICMS00></ICMS>', v, v * 0.18, 0, 0)
+    if grupo == 'ICMS10':
+        bcst = v * 1.4
+        st = bcst * 0.18 - v * 0.12
+        return (f'<ICMS><ICMS10><orig>0</orig><CST>10</CST><modBC>3</modBC><vBC>{v:.2f}</vBC><pICMS>12.00</pICMS>'
+                f'<vICMS>{v * 0.12:.2f}</vICMS><modBCST>4</modBCST><pMVAST>40.00</pMVAST><vBCST>{bcst:.2f}</vBCST>'
+                f'<pICMSST>18.00</pICMSST><vICMSST>{st:.2f}</vICMSST></ICMS10></ICMS>', v, v * 0.12, bcst, st)
+    if grupo == 'ICMS60':
+        return ('<ICMS><ICMS60><orig>0</orig><CST>60</CST><vBCSTRet>0.00</vBCSTRet><vICMSSTRet>0.00</vICMSSTRet>'
+                '</ICMS60></ICMS>', 0, 0, 0, 0)
+    csosn = grupo[5:]
+    tag = 'ICMSSN101' if csosn == '101' else 'ICMSSN500' if csosn == '500' else 'ICMSSN102'
+    extra = '<pCredSN>2.56</pCredSN><vCredICMSSN>0.00</vCredICMSSN>' if csosn == '101' else ''
+    return f'<ICMS><{tag}><orig>0</orig><CSOSN>{csosn}</CSOSN>{extra}</{tag}></ICMS>', 0, 0, 0, 0
+
+def _ipi(rnd, v, prob):
+    if rnd.random() >= prob: return '', 0
+    if rnd.random() < 0.2:
+        return '<IPI><cEnq>999</cEnq><IPINT><CST>53</CST></IPINT></IPI>', 0
+    p = rnd.choice([5.0, 10.0, 15.0])
+    return (f'<IPI><cEnq>999</cEnq><IPITrib><CST>50</CST><vBC>{v:.2f}</vBC><pIPI>{p:.2f}</pIPI>'
+            f'<vIPI>{v * p / 100:.2f}</vIPI></IPITrib></IPI>', v * p / 100)
+
+def gerar_nota(rnd, nnf, qtd_itens, emit, dest, dt, grupos=GRUPOS_ICMS, prob_ipi=0.3, proc=True):
+    (cnpj_emit, nome_emit, uf_emit), (cnpj_dest, nome_dest, uf_dest) = emit, dest
+    chave = chave_acesso(uf_emit, dt, cnpj_emit, 1, nnf, rnd.randint(0, 99999999))
+    interna = uf_emit == uf_dest
+    # Simples Nacional usa CSOSN em todos os itens; regime normal usa CST
+    simples = rnd.random() < 0.3 and any(g.startswith('CSOSN') for g in grupos)
+    opcoes = [g for g in grupos if g.startswith('CSOSN') == simples] or list(grupos)
+
+    dets, tot = [], dict(vBC=0, vICMS=0, vBCST=0, vST=0, vProd=0, vDesc=0, vIPI=0)
+    for i in range(qtd_itens):
+        q = rnd.randint(1, 50)
+        vun = round(rnd.uniform(0.5, 2000), 4)
+        vprod = round(q * vun, 2)
+        vdesc = round(vprod * 0.05, 2) if rnd.random() < 0.15 else 0
+        icms, bc, vicms, bcst, st = _icms(rnd.choice(opcoes), vprod - vdesc)
+        ipi, vipi = _ipi(rnd, vprod - vdesc, prob_ipi)
+        for k, v in (('vBC', bc), ('vICMS', vicms), ('vBCST', bcst), ('vST', st), ('vProd', vprod), ('vDesc', vdesc), ('vIPI', vipi)):
+            tot[k] += round(v, 2)
+        cfop = rnd.choice(['5102', '5405', '5101']) if interna else rnd.choice(['6102', '6108', '6101'])
+        desc = f'<vDesc>{vdesc:.2f}</vDesc>' if vdesc else ''
+        dets.append(
+            f'<det nItem="{i + 1}"><prod><cProd>{rnd.randint(1000, 99999)}</cProd><cEAN>SEM GTIN</cEAN>'
+            f'<xProd>{rnd.choice(PRODUTOS)} {i + 1}</xProd><NCM>{rnd.choice(NCMS)}</NCM><CFOP>{cfop}</CFOP>'
+            f'<uCom>{rnd.choice(UNIDADES)}</uCom><qCom>{q:.4f}</qCom><vUnCom>{vun:.10f}</vUnCom><vProd>{vprod:.2f}</vProd>'
+            f'<cEANTrib>SEM GTIN</cEANTrib><uTrib>UN</uTrib><qTrib>{q:.4f}</qTrib><vUnTrib>{vun:.10f}</vUnTrib>{desc}'
+            f'<indTot>1</indTot></prod><imposto><vTotTrib>0.00</vTotTrib>{icms}{ipi}'
+            f'<PIS><PISAliq><CST>01</CST><vBC>{vprod:.2f}</vBC><pPIS>1.65</pPIS><vPIS>{vprod * 0.0165:.2f}</vPIS></PISAliq></PIS>'
+            f'<COFINS><COFINSAliq><CST>01</CST><vBC>{vprod:.2f}</vBC><pCOFINS>7.60</pCOFINS><vCOFINS>{vprod * 0.076:.2f}</vCOFINS>'
+            f'</COFINSAliq></COFINS></imposto></det>')
+    vnf = tot['vProd'] - tot['vDesc'] + tot['vST'] + tot['vIPI']
+
+    inf = (
+        f'<infNFe Id="NFe{chave}" versao="4.00"><ide><cUF>{UFS[uf_emit]}</cUF><cNF>{chave[35:43]}</cNF>'
+        f'<natOp>VENDA DE MERCADORIA</natOp><mod>55</mod><serie>1</serie><nNF>{nnf}</nNF>'
+        f'<dhEmi>{dt.isoformat()}T{rnd.randint(8, 18):02d}:{rnd.randint(0, 59):02d}:00-03:00</dhEmi><tpNF>1</tpNF>'
+        f'<idDest>{1 if interna else 2}</idDest><tpImp>1</tpImp><tpEmis>1</tpEmis><cDV>{chave[-1]}</cDV><tpAmb>1</tpAmb>'
+        f'<finNFe>1</finNFe><indFinal>0</indFinal><indPres>1</indPres><procEmi>0</procEmi><verProc>1.0</verProc></ide>'
+        f'<emit><CNPJ>{cnpj_emit}</CNPJ><xNome>{nome_emit}</xNome><enderEmit><xLgr>Rua Exemplo</xLgr><nro>100</nro>'
+        f'<xBairro>Centro</xBairro><cMun>3550308</cMun><xMun>Cidade</xMun><UF>{uf_emit}</UF><CEP>01001000</CEP>'
+        f'</enderEmit><IE>{cnpj_emit[:9]}</IE><CRT>{1 if simples else 3}</CRT></emit>'
+        f'<dest><CNPJ>{cnpj_dest}</CNPJ><xNome>{nome_dest}</xNome><enderDest><xLgr>Av Teste</xLgr><nro>200</nro>'
+        f'<xBairro>Centro</xBairro><cMun>3304557</cMun><xMun>Cidade</xMun><UF>{uf_dest}</UF></enderDest>'
+        f'<indIEDest>1</indIEDest><IE>{cnpj_dest[:9]}</IE></dest>'
+        f'{"".join(dets)}'
+        f'<total><ICMSTot><vBC>{tot["vBC"]:.2f}</vBC><vICMS>{tot["vICMS"]:.2f}</vICMS><vICMSDeson>0.00</vICMSDeson>'
+        f'<vBCST>{tot["vBCST"]:.2f}</vBCST><vST>{tot["vST"]:.2f}</vST><vProd>{tot["vProd"]:.2f}</vProd><vFrete>0.00</vFrete>'
+        f'<vSeg>0.00</vSeg><vDesc>{tot["vDesc"]:.2f}</vDesc><vII>0.00</vII><vIPI>{tot["vIPI"]:.2f}</vIPI><vPIS>0.00</vPIS>'
+        f'<vCOFINS>0.00</vCOFINS><vOutro>0.00</vOutro><vNF>{vnf:.2f}</vNF></ICMSTot></total>'
+        f'<transp><modFrete>0</modFrete></transp><pag><detPag><tPag>15</tPag><vPag>{vnf:.2f}</vPag></detPag></pag>'
+        f'<infAdic><infCpl>Documento gerado para testes</infCpl></infAdic></infNFe>'
+    )
+    nfe = f'<NFe xmlns="{NS}">{inf}</NFe>'
+    if not proc: return chave, f'<?xml version="1.0" encoding="UTF-8"?>{nfe}'.encode()
+    prot = (f'<protNFe versao="4.00"><infProt><tpAmb>1</tpAmb><verAplic>SP_NFE_PL</verAplic><chNFe>{chave}</chNFe>'
+            f'<dhRecbto>{dt.isoformat()}T19:00:00-03:00</dhRecbto><nProt>1{nnf:014d}</nProt><cStat>100</cStat>'
+            f'<xMotivo>Autorizado o uso da NF-e</xMotivo></infProt></protNFe>')
+    return chave, f'<?xml version="1.0" encoding="UTF-8"?><nfeProc xmlns="{NS}" versao="4.00">{nfe}{prot}</nfeProc>'.encode()
+
+def gerar_corpus(qtd_notas, itens=(1, 30), grupos=GRUPOS_ICMS, prob_ipi=0.3, anos=(2023, 2024), qtd_empresas=20, seed=42):
+    """Gera (nome_arquivo, bytes) para cada nota. Mesma seed, mesmo corpus."""
+    rnd = random.Random(seed)
+    empresas = [(cnpj(rnd), f"Empresa {i + 1} Ltda", rnd.choice(list(UFS))) for i in range(qtd_empresas)]
+    for n in range(qtd_notas):
+        emit, dest = rnd.sample(empresas, 2)
+        dt = date(rnd.choice(anos), rnd.randint(1, 12), rnd.randint(1, 28))
+        chave, xml = gerar_nota(rnd, n + 1, rnd.randint(*itens), emit, dest, dt, grupos, prob_ipi, proc=rnd.random() < 0.9)
+        yield f"{chave}-nfe.xml", xml
+
+def gravar_zips(destino, notas, zip_mb=50):
+    """Empacota as notas em ZIPs de até zip_mb MB (compactados). Devolve os caminhos criados."""
+    os.makedirs(destino, exist_ok=True)
+    caminhos, z, atual = [], None, None
+    for nome, xml in notas:
+        if z is None or atual.tell() >= zip_mb * 1024 * 1024:
+            if z is not None: z.close()
+            atual = open(os.path.join(destino, f"lote_{len(caminhos) + 1:04d}.zip"), 'wb')
+            caminhos.append(atual.name)
+            z = zipfile.ZipFile(atual, 'w', zipfile.ZIP_DEFLATED)
+        z.writestr(nome, xml)
+    if z is not None: z.close()
+    return caminhos
+
+def _intervalo(txt):
+    a, _, b = txt.partition('-')
+    return int(a), int(b or a)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Gera um corpus sintético de NF-e em ZIPs.")
+    ap.add_argument("saida")
+    ap.add_argument("--notas", type=int, default=1000)
+    ap.add_argument("--itens", type=_intervalo, default=(1, 30), help="itens por nota, ex.: 1-30")
+    ap.add_argument("--grupos", default=','.join(GRUPOS_ICMS), help="grupos de ICMS sorteados nos itens")
+    ap.add_argument("--ipi", type=float, default=0.3, help="fração dos itens com IPI")
+    ap.add_argument("--zip-mb", type=float, default=50)
+    ap.add_argument("--seed", type=int, default=42)
+    args = ap.parse_args()
+    notas = gerar_corpus(args.notas, args.itens, args.grupos.split(','), args.ipi, seed=args.seed)
+    for c in gravar_zips(args.saida, notas, args.zip_mb): print(c)
@@ -1,439 +1,2462 @@
-import os
-import shutil
-import zipfile
-import glob
-import pandas as pd
-import xml.etree.ElementTree as ET
-from typing import List
-from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
-from sqlalchemy import create_engine, Column, String, Float
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from datetime import datetime
-
-app = FastAPI()
-
-# --- CONFIGURAÇÃO DE PASTAS ---
-TEMP_DIR = "temp_files"
-REPORTS_DIR = "meus_relatorios"
-
-for d in [TEMP_DIR, REPORTS_DIR]:
-    if not os.path.exists(d): os.makedirs(d)
-
-# --- BANCO DE DADOS ---
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./nfe_data.db")
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
-
-class NFe(Base):
-    __tablename__ = "notas_fiscais_v6" # V6: Tabela nova para garantir os novos campos (CST, Aliquotas)
-    chave_item = Column(String, primary_key=True, index=True)
-    chave_acesso = Column(String)
-    ano = Column(String)
-    mes = Column(String)
-    cnpj_emitente = Column(String)
-    cnpj_destinatario = Column(String)
-    dados_json = Column(String)
-
-Base.metadata.create_all(bind=engine)
-
-# --- FUNÇÕES ---
-ns_map = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
-
-def get_val(node, path, type_fn=str):
-    if node is None: return type_fn(0) if type_fn in [float, int] else ""
-    try:
-        r = node.find(path, ns_map)
-        if r is None: r = node.find(path.replace('nfe:', ''))
-        if r is not None and r.text:
-            return type_fn(r.text.replace(',', '.'))
-    except: pass
-    return type_fn(0) if type_fn in [float, int] else ""
-
-def parse_xml(filepath):
-    try:
-        tree = ET.parse(filepath)
-        root = tree.getroot()
-        if 'nfeProc' in root.tag: inf = root.find('.//nfe:infNFe', ns_map)
-        else: inf = root.find('nfe:infNFe', ns_map)
-        if inf is None: return []
-
-        ide = inf.find('nfe:ide', ns_map)
-        emit = inf.find('nfe:emit', ns_map)
-        dest = inf.find('nfe:dest', ns_map)
-        total = inf.find('.//nfe:ICMSTot', ns_map)
-        
-        prot = root.find('.//nfe:infProt', ns_map)
-        chave = get_val(prot, 'nfe:chNFe') or inf.attrib.get('Id', '')[3:]
-        
-        dt_str = get_val(ide, 'nfe:dhEmi') or get_val(ide, 'nfe:dEmi')
-        dt = datetime.now()
-        if len(dt_str) >= 10: dt = datetime.strptime(dt_str[:10], '%Y-%m-%d')
-
-        # Extração de totais (Cabeçalho)
-        v_bc_tot = get_val(total, 'nfe:vBC', float)
-        v_icms_tot = get_val(total, 'nfe:vICMS', float)
-        v_bcst_tot = get_val(total, 'nfe:vBCST', float)
-        v_st_tot = get_val(total, 'nfe:vST', float)
-        v_desc_tot = get_val(total, 'nfe:vDesc', float)
-        v_ipi_tot = get_val(total, 'nfe:vIPI', float)
-        v_prod_tot = get_val(total, 'nfe:vProd', float)
-        v_nf_tot = get_val(total, 'nfe:vNF', float)
-
-        itens_db = []
-        for i, det in enumerate(inf.findall('nfe:det', ns_map)):
-            prod = det.find('nfe:prod', ns_map)
-            imposto = det.find('nfe:imposto', ns_map)
-            
-            # --- LÓGICA AVANÇADA PARA CST E IMPOSTOS DO ITEM ---
-            # CST pode estar em vários lugares (ICMS00, ICMS10, CSOSN101, etc)
-            # Buscamos recursivamente (.//) dentro da tag imposto
-            cst = get_val(imposto, './/nfe:CST')
-            if not cst: cst = get_val(imposto, './/nfe:CSOSN') # Se for Simples Nacional
-            
-            # Valores Específicos do Item (Busca profunda)
-            v_bc_item = get_val(imposto, './/nfe:ICMS//nfe:vBC', float)
-            p_icms_item = get_val(imposto, './/nfe:ICMS//nfe:pICMS', float)
-            v_icms_item = get_val(imposto, './/nfe:ICMS//nfe:vICMS', float)
-            
-            p_ipi_item = get_val(imposto, './/nfe:IPI//nfe:pIPI', float)
-            v_ipi_item = get_val(imposto, './/nfe:IPI//nfe:vIPI', float)
-
-            row = {
-                # CAMPOS SOLICITADOS EXATAMENTE
-                'Mês': str(dt.month).zfill(2),
-                'Ano': str(dt.year),
-                'Chave Acesso NFe': chave,
-                'Inscrição Destinatário': get_val(dest, 'nfe:IE'),
-                'Inscrição Emitente': get_val(emit, 'nfe:IE'),
-                'Razão Social Emitente': get_val(emit, 'nfe:xNome'),
-                'Cnpj Emitente': get_val(emit, 'nfe:CNPJ'),
-                'UF Emitente': get_val(emit, 'nfe:enderEmit/nfe:UF'),
-                'Nr NFe': get_val(ide, 'nfe:nNF'),
-                'Série': get_val(ide, 'nfe:serie'),
-                'Data NFe': dt.strftime('%d/%m/%Y'),
-                
-                # Totais
-                'BC ICMS Total': v_bc_tot,
-                'ICMS Total': v_icms_tot,
-                'BC ST Total': v_bcst_tot,
-                'ICMS ST Total': v_st_tot,
-                'Desc Total': v_desc_tot,
-                'IPI Total': v_ipi_tot,
-                'Total Produtos': v_prod_tot,
-                'Total NFe': v_nf_tot,
-                
-                # Item
-                'Descrição Produto NFe': get_val(prod, 'nfe:xProd'),
-                'NCM na NFe': get_val(prod, 'nfe:NCM'),
-                'CST': cst,
-                'CFOP NFe': get_val(prod, 'nfe:CFOP'),
-                'Qtde': get_val(prod, 'nfe:qCom', float),
-                'Unid': get_val(prod, 'nfe:uCom'),
-                'Vr Unit': get_val(prod, 'nfe:vUnCom', float),
-                'Vr Total': get_val(prod, 'nfe:vProd', float),
-                'Desconto Item': get_val(prod, 'nfe:vDesc', float),
-                
-                # Impostos Detalhados do Item
-                'Base de Cálculo ICMS': v_bc_item,
-                'Aliq ICMS': p_icms_item,
-                'Vr ICMS': v_icms_item,
-                'Aliq IPI': p_ipi_item,
-                'Vr IPI': v_ipi_item
-            }
-            
-            itens_db.append(NFe(
-                chave_item=f"{chave}-{i+1}", 
-                chave_acesso=chave, 
-                ano=str(dt.year),
-                mes=str(dt.month).zfill(2),
-                cnpj_emitente=get_val(emit, 'nfe:CNPJ'),
-                cnpj_destinatario=get_val(dest, 'nfe:CNPJ'),
-                dados_json=str(row)
-            ))
-        return itens_db
-    except: return []
-
-# --- ROTAS ---
-@app.post("/upload")
-async def upload(files: List[UploadFile] = File(...)):
-    if os.path.exists(TEMP_DIR): 
-        shutil.rmtree(TEMP_DIR)
-        os.makedirs(TEMP_DIR)
-
-    c_arquivos = 0
-    c_itens = 0
-    sess = SessionLocal()
-
-    try:
-        for file in files:
-            file_path = os.path.join(TEMP_DIR, file.filename)
-            with open(file_path, "wb") as b: shutil.copyfileobj(file.file, b)
-            try:
-                with zipfile.ZipFile(file_path, 'r') as z: z.extractall(TEMP_DIR)
-            except: continue
-
-        xml_files = glob.glob(f"{TEMP_DIR}/**/*.xml", recursive=True) + glob.glob(f"{TEMP_DIR}/**/*.XML", recursive=True)
-        c_arquivos = len(xml_files)
-
-        for f in xml_files:
-            itens = parse_xml(f)
-            for item in itens:
-                sess.merge(item)
-                c_itens += 1
-        sess.commit()
-
-        return JSONResponse({"ok": True, "msg": f"{c_arquivos} XMLs lidos. {c_itens} itens processados."})
-
-    except Exception as e:
-        sess.rollback()
-        return JSONResponse({"ok": False, "msg": str(e)})
-    finally:
-        sess.close()
-
-@app.get("/filtros")
-async def get_filtros():
-    s = SessionLocal()
-    anos = s.query(NFe.ano).distinct().order_by(NFe.ano).all()
-    s.close()
-    return {"anos": [x[0] for x in anos]}
-
-@app.get("/historico")
-async def get_historico():
-    files = []
-    for f in os.listdir(REPORTS_DIR):
-        if f.endswith(".xlsx"):
-            path = os.path.join(REPORTS_DIR, f)
-            t = os.path.getmtime(path)
-            dt = datetime.fromtimestamp(t).strftime('%d/%m/%Y %H:%M')
-            files.append({"nome": f, "data": dt})
-    files.sort(key=lambda x: x['nome'], reverse=True)
-    return {"arquivos": files}
-
-@app.post("/gerar")
-async def gerar(anos: str = Form(...), meu_cnpj: str = Form("")):
-    s = SessionLocal()
-    try:
-        l_anos = anos.split(',')
-        res = s.query(NFe).filter(NFe.ano.in_(l_anos)).all()
-        if not res: return JSONResponse({"ok": False, "msg": "Sem dados."})
-
-        data = [eval(r.dados_json) for r in res]
-        df = pd.DataFrame(data)
-
-        # Lógica para o Resumo na Tela (Entrada vs Saida)
-        # Nota: Mantemos isso para a tela, mas NÃO colocamos no Excel pois você pediu ordem exata
-        def classificar(row):
-            if not meu_cnpj: return "Indefinido"
-            cnpj_limpo = ''.join(filter(str.isdigit, meu_cnpj))
-            emit = ''.join(filter(str.isdigit, str(row.get('Cnpj Emitente', '')))) # Usando a chave exata
-            dest = ''.join(filter(str.isdigit, str(row.get('Destinatário CNPJ', '')))) # Chave pode variar se XML for ruim, mas tentamos
-            if emit == cnpj_limpo: return "SAÍDA"
-            if dest == cnpj_limpo: return "ENTRADA"
-            return "OUTROS"
-
-        if meu_cnpj:
-            df['__temp_tipo'] = df.apply(classificar, axis=1)
-
-        # Ordenação Cronológica
-        df = df.sort_values(by=['Ano', 'Mês', 'Data NFe'])
-
-        # --- DEFINIÇÃO ESTRITA DAS COLUNAS (ORDEM SOLICITADA) ---
-        cols = [
-            'Mês', 'Ano', 'Chave Acesso NFe', 'Inscrição Destinatário', 'Inscrição Emitente',
-            'Razão Social Emitente', 'Cnpj Emitente', 'UF Emitente', 'Nr NFe', 'Série', 'Data NFe',
-            'BC ICMS Total', 'ICMS Total', 'BC ST Total', 'ICMS ST Total', 'Desc Total', 'IPI Total',
-            'Total Produtos', 'Total NFe', 'Descrição Produto NFe', 'NCM na NFe', 'CST', 'CFOP NFe',
-            'Qtde', 'Unid', 'Vr Unit', 'Vr Total', 'Desconto Item', 
-            'Base de Cálculo ICMS', 'Aliq ICMS', 'Vr ICMS', 'Aliq IPI', 'Vr IPI'
-        ]
-        
-        # Garante que só essas colunas saiam e nessa ordem
-        df = df.reindex(columns=cols).fillna("")
-
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"Relatorio_Fiscal_{timestamp}.xlsx"
-        filepath = os.path.join(REPORTS_DIR, filename)
-        df.to_excel(filepath, index=False)
-
-        # Prova Real
-        v_itens = df['Vr Total'].replace('', 0).astype(float).sum()
-        df_unicas = df.drop_duplicates(subset=['Chave Acesso NFe'])
-        v_notas = df_unicas['Total NFe'].replace('', 0).astype(float).sum()
-        
-        # Resumo Entradas/Saidas (Apenas contagem visual)
-        resumo_msg = "Sem filtro de CNPJ"
-        if meu_cnpj and '__temp_tipo' in df:
-            entradas = len(df_unicas[df_unicas['__temp_tipo'] == 'ENTRADA'])
-            saidas = len(df_unicas[df_unicas['__temp_tipo'] == 'SAÍDA'])
-            resumo_msg = f"Entradas: {entradas} | Saídas: {saidas}"
-
-        return JSONResponse({
-            "ok": True,
-            "filename": filename,
-            "notas": f"R$ {v_notas:,.2f}",
-            "itens": f"R$ {v_itens:,.2f}",
-            "qtd_notas": len(df_unicas),
-            "resumo_ops": resumo_msg,
-            "url": f"/download/{filename}"
-        })
-    finally: s.close()
-
-@app.get("/download/{filename}")
-async def download(filename: str):
-    path = os.path.join(REPORTS_DIR, filename)
-    if os.path.exists(path): return FileResponse(path, filename=filename)
-    return JSONResponse({"msg": "Arquivo não encontrado"}, 404)
-
-# --- FRONTEND ---
-@app.get("/", response_class=HTMLResponse)
-async def home():
-    return """
-    <!DOCTYPE html>
-    <html lang="pt-br">
-    <head>
-        <meta charset="UTF-8">
-        <title>Extrator Fiscal V6</title>
-        <script src="https://cdn.tailwindcss.com"></script>
-        <script src="https://cdn.jsdelivr.net/npm/sweetalert2@11"></script>
-        <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css" rel="stylesheet">
-    </head>
-    <body class="bg-slate-50 min-h-screen text-slate-800 font-sans">
-        <div class="max-w-6xl mx-auto p-6 grid grid-cols-1 lg:grid-cols-3 gap-6">
-            
-            <div class="lg:col-span-2 space-y-6">
-                <div class="bg-white p-6 rounded-xl shadow border border-slate-200">
-                    <h2 class="text-xl font-bold text-blue-700 mb-4"><i class="fas fa-upload"></i> Importar Dados</h2>
-                    <div id="dropZone" class="border-2 border-dashed border-slate-300 rounded-lg p-10 text-center hover:bg-blue-50 hover:border-blue-400 transition cursor-pointer group">
-                        <i class="fas fa-file-archive text-5xl text-slate-300 group-hover:text-blue-500 mb-3 transition"></i>
-                        <p class="font-medium text-slate-600">Arraste múltiplos ZIPs aqui</p>
-                        <input type="file" id="fileInput" accept=".zip" multiple class="hidden">
-                    </div>
-                </div>
-
-                <div class="bg-white p-6 rounded-xl shadow border border-slate-200">
-                    <h2 class="text-xl font-bold text-green-700 mb-4"><i class="fas fa-filter"></i> Gerar Relatório</h2>
-                    <div class="grid grid-cols-1 md:grid-cols-2 gap-4 mb-4">
-                        <div>
-                            <label class="block text-sm font-bold text-slate-600 mb-1">Seu CNPJ (Opcional)</label>
-                            <input type="text" id="meuCnpj" placeholder="Números apenas" class="w-full border border-slate-300 rounded p-2 focus:ring focus:ring-blue-200 outline-none">
-                        </div>
-                        <div>
-                            <label class="block text-sm font-bold text-slate-600 mb-1">Anos Disponíveis</label>
-                            <div id="anosList" class="flex flex-wrap gap-2 text-sm">Carregando...</div>
-                        </div>
-                    </div>
-                    <button id="btnGerar" onclick="gerar()" disabled class="w-full bg-slate-300 text-white font-bold py-3 rounded-lg shadow transition">
-                        Selecione um ano
-                    </button>
-                </div>
-            </div>
-
-            <div class="bg-white p-6 rounded-xl shadow border border-slate-200 h-fit">
-                <h2 class="text-xl font-bold text-purple-700 mb-4"><i class="fas fa-history"></i> Relatórios Gerados</h2>
-                <div id="historicoList" class="space-y-2 max-h-[500px] overflow-y-auto pr-2">
-                    <div class="text-center text-slate-400 py-4"><i class="fas fa-circle-notch fa-spin"></i></div>
-                </div>
-                <button onclick="loadHistorico()" class="mt-4 text-sm text-blue-600 hover:underline w-full text-center"><i class="fas fa-sync"></i> Atualizar</button>
-            </div>
-        </div>
-
-        <script>
-            const dropZone = document.getElementById('dropZone');
-            const fileInput = document.getElementById('fileInput');
-            dropZone.onclick = () => fileInput.click();
-            fileInput.onchange = () => handleFiles(fileInput.files);
-            ['dragenter', 'dragover', 'dragleave', 'drop'].forEach(evt => {
-                dropZone.addEventListener(evt, e => { e.preventDefault(); e.stopPropagation(); });
-            });
-            dropZone.addEventListener('drop', e => handleFiles(e.dataTransfer.files));
-
-            async function handleFiles(files) {
-                if(!files.length) return;
-                let fd = new FormData();
-                let hasZip = false;
-                for(let i=0; i<files.length; i++) {
-                    if(files[i].name.toLowerCase().endsWith('.zip')) {
-                        fd.append('files', files[i]);
-                        hasZip = true;
-                    }
-                }
-                if(!hasZip) return Swal.fire('Erro', 'Envie ZIPs.', 'error');
-                Swal.fire({title: 'Importando...', html: 'Lendo XMLs...', didOpen: () => Swal.showLoading()});
-                try {
-                    let res = await fetch('/upload', {method:'POST', body:fd});
-                    let data = await res.json();
-                    if(data.ok) { Swal.fire('Sucesso!', data.msg, 'success'); loadFiltros(); }
-                    else { Swal.fire('Erro', data.msg, 'error'); }
-                } catch(e) { Swal.fire('Erro', 'Falha na conexão.', 'error'); }
-            }
-
-            async function loadFiltros() {
-                let res = await fetch('/filtros');
-                let data = await res.json();
-                let div = document.getElementById('anosList');
-                div.innerHTML = '';
-                if(data.anos.length === 0) div.innerHTML = 'Nenhum dado.';
-                data.anos.forEach(ano => {
-                    div.innerHTML += `<label class="cursor-pointer select-none"><input type="checkbox" value="${ano}" onchange="checkBtn()" class="peer sr-only"><span class="px-3 py-1 rounded bg-slate-100 border text-slate-500 peer-checked:bg-green-600 peer-checked:text-white peer-checked:border-green-600 transition text-xs font-bold">${ano}</span></label>`;
-                });
-            }
-
-            async function loadHistorico() {
-                let div = document.getElementById('historicoList');
-                try {
-                    let res = await fetch('/historico');
-                    let data = await res.json();
-                    div.innerHTML = '';
-                    if(data.arquivos.length === 0) { div.innerHTML = '<div class="text-sm text-slate-400 text-center">Nenhum relatório.</div>'; return; }
-                    data.arquivos.forEach(file => {
-                        div.innerHTML += `<div class="flex items-center justify-between p-3 bg-slate-50 rounded hover:bg-blue-50 border border-slate-100 transition group"><div><div class="text-sm font-bold text-slate-700 truncate w-40" title="${file.nome}">${file.nome}</div><div class="text-xs text-slate-400">${file.data}</div></div><a href="/download/${file.nome}" class="text-blue-500 hover:text-blue-700 bg-white p-2 rounded-full shadow-sm"><i class="fas fa-download"></i></a></div>`;
-                    });
-                } catch(e) { div.innerHTML = 'Erro ao carregar.'; }
-            }
-
-            function checkBtn() {
-                let count = document.querySelectorAll('input[type="checkbox"]:checked').length;
-                let btn = document.getElementById('btnGerar');
-                if(count > 0) {
-                    btn.disabled = false;
-                    btn.className = "w-full bg-green-600 hover:bg-green-700 text-white font-bold py-3 rounded-lg shadow transition transform active:scale-95";
-                    btn.innerText = "Gerar Relatório";
-                } else {
-                    btn.disabled = true;
-                    btn.className = "w-full bg-slate-300 text-white font-bold py-3 rounded-lg shadow transition cursor-not-allowed";
-                    btn.innerText = "Selecione um ano";
-                }
-            }
-
-            async function gerar() {
-                let anos = Array.from(document.querySelectorAll('input[type="checkbox"]:checked')).map(x => x.value).join(',');
-                let cnpj = document.getElementById('meuCnpj').value;
-                Swal.fire({title: 'Gerando...', html: 'Criando Excel...', didOpen: () => Swal.showLoading()});
-                let fd = new FormData();
-                fd.append('anos', anos);
-                fd.append('meu_cnpj', cnpj);
-                try {
-                    let res = await fetch('/gerar', {method:'POST', body:fd});
-                    let data = await res.json();
-                    if(data.ok) {
-                        loadHistorico();
-                        Swal.fire({
-                            title: 'Sucesso!',
-                            icon: 'success',
-                            html: `<div class="bg-slate-100 p-3 rounded text-left text-sm space-y-2 mb-4"><div class="flex justify-between border-b pb-1"><span>Total Notas:</span> <span class="font-bold text-green-700">${data.notas}</span></div><div class="flex justify-between border-b pb-1"><span>Total Itens:</span> <span class="font-bold text-blue-700">${data.itens}</span></div><div class="text-center font-bold text-slate-600 pt-1">${data.resumo_ops}</div></div>`,
-                            confirmButtonText: 'Baixar',
-                            showCancelButton: true,
-                            cancelButtonText: 'Fechar'
-                        }).then((result) => { if(result.isConfirmed) window.location.href = data.url; });
-                    } else { Swal.fire('Erro', data.msg, 'error'); }
-                } catch(e) { Swal.fire('Erro', 'Falha ao processar.', 'error'); }
-            }
-            loadFiltros();
-            loadHistorico();
-        </script>
-    </body>
-    </html>
-    """
+import csv
+import hashlib
+import heapq
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+try: import fcntl
+except ImportError: fcntl = None  # Windows: a trava das partes fica só entre threads
+import anyio.to_thread
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import xml.etree.ElementTree as ET
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, ExitStack
+from contextvars import ContextVar
+from itertools import islice
+from operator import itemgetter
+from typing import List
+from fastapi import FastAPI, UploadFile, File, Form, Request, Depends
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, text, select, update, delete, func, case, cast, insert, and_, or_, tuple_, literal, null, Column, String, Text, Integer, BigInteger, Date, DateTime, Numeric, Index
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from datetime import datetime, timedelta
+
+app = FastAPI()
+
+# --- CONFIGURAÇÃO DE PASTAS ---
+REPORTS_DIR = "meus_relatorios"
+UPLOAD_DIR = "uploads"  # ZIPs recebidos pelos jobs de importação, apagados ao final do job (órfãos: limpar_spool)
+
+for d in [REPORTS_DIR, UPLOAD_DIR]:
+    if not os.path.exists(d): os.makedirs(d)
+
+# --- BANCO DE DADOS ---
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./nfe_data.db")
+# Pool de conexões por processo: com vários workers (WEB_CONCURRENCY), o total no banco é
+# workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW), e precisa caber no max_connections do Postgres
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # segundos; evita conexão derrubada pelo servidor/proxy
+if DATABASE_URL.startswith("sqlite"): engine = create_engine(DATABASE_URL)
+else: engine = create_engine(DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                             pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=True)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+Base = declarative_base()
+
+Valor = Numeric(asdecimal=False)  # NUMERIC no banco, float no Python
+
+class NFe(Base):
+    __tablename__ = "notas_fiscais_v7" # V7: cada campo do relatório numa coluna tipada (sem dados_json); migrar com migrar_v7.py
+    chave_item = Column(String, primary_key=True)
+    mes = Column(String)
+    ano = Column(String)
+    chave_acesso = Column(String, index=True)
+    inscricao_destinatario = Column(String)
+    inscricao_emitente = Column(String)
+    razao_social_emitente = Column(String)
+    cnpj_emitente = Column(String)
+    uf_emitente = Column(String)
+    nr_nfe = Column(String)
+    serie = Column(String)
+    data_nfe = Column(Date)
+    bc_icms_total = Column(Valor)
+    icms_total = Column(Valor)
+    bc_st_total = Column(Valor)
+    icms_st_total = Column(Valor)
+    desc_total = Column(Valor)
+    ipi_total = Column(Valor)
+    total_produtos = Column(Valor)
+    total_nfe = Column(Valor)
+    descricao_produto = Column(String)
+    ncm = Column(String)
+    cst = Column(String)
+    cfop = Column(String)
+    qtde = Column(Valor)
+    unid = Column(String)
+    vr_unit = Column(Valor)
+    vr_total = Column(Valor)
+    desconto_item = Column(Valor)
+    bc_icms = Column(Valor)
+    aliq_icms = Column(Valor)
+    vr_icms = Column(Valor)
+    aliq_ipi = Column(Valor)
+    vr_ipi = Column(Valor)
+    cnpj_destinatario = Column(String)
+
+    # Filtros do relatório: cada um com o período junto, para o banco resolver filtro + ordenação pelo índice
+    __table_args__ = (
+        Index('ix_nfe_v7_ano_mes', 'ano', 'mes'),
+        Index('ix_nfe_v7_emitente_periodo', 'cnpj_emitente', 'ano', 'mes'),
+        Index('ix_nfe_v7_destinatario_periodo', 'cnpj_destinatario', 'ano', 'mes'),
+        Index('ix_nfe_v7_cfop_periodo', 'cfop', 'ano', 'mes'),
+        Index('ix_nfe_v7_ncm_periodo', 'ncm', 'ano', 'mes'),
+        Index('ix_nfe_v7_uf_periodo', 'uf_emitente', 'ano', 'mes'),
+    )
+
+class Documento(Base):
+    __tablename__ = "documentos"  # Índice dos XMLs já importados: reenvio do mesmo XML é ignorado antes do parse
+    chave_acesso = Column(String, primary_key=True)
+    hash = Column(String, index=True)  # sha256 do conteúdo do XML
+    qtd_itens = Column(Integer)
+    importado_em = Column(DateTime)
+
+class HashDocumento(Base):
+    # Todo conteúdo já importado, não só o da versão atual de cada nota: o mesmo ZIP com NFe e procNFe
+    # da mesma chave é ignorado por inteiro no reenvio
+    __tablename__ = "documentos_hashes"
+    hash = Column(String, primary_key=True)
+    chave_acesso = Column(String, index=True)
+
+class ResumoNota(Base):
+    __tablename__ = "resumo_notas"  # Uma linha por nota, mantida na importação (prova real sem ler os itens)
+    chave_acesso = Column(String, primary_key=True)
+    ano = Column(String)
+    mes = Column(String)
+    cnpj_emitente = Column(String)
+    cnpj_destinatario = Column(String)
+    qtd_itens = Column(Integer)
+    total_nfe = Column(Valor)
+    total_itens = Column(Valor)
+
+    __table_args__ = (Index('ix_resumo_notas_ano_mes', 'ano', 'mes'),)
+
+class ResumoMensal(Base):
+    __tablename__ = "resumo_mensal"  # Totais por (ano, mes, emitente, destinatário)
+    ano = Column(String, primary_key=True)
+    mes = Column(String, primary_key=True)
+    cnpj_emitente = Column(String, primary_key=True)
+    cnpj_destinatario = Column(String, primary_key=True)
+    qtd_notas = Column(Integer)
+    qtd_itens = Column(Integer)
+    total_notas = Column(Valor)
+    total_itens = Column(Valor)
+
+class Faceta(Base):
+    __tablename__ = "facetas"  # Valores de cada filtro com contagem de notas/itens por mês, mantidos na importação
+    dimensao = Column(String, primary_key=True)  # emitente | destinatario | cfop | ncm | uf
+    valor = Column(String, primary_key=True)
+    ano = Column(String, primary_key=True)
+    mes = Column(String, primary_key=True)
+    descricao = Column(String)                   # razão social, no caso do emitente
+    qtd_notas = Column(Integer)
+    qtd_itens = Column(Integer)
+
+class VersaoDados(Base):
+    __tablename__ = "versao_dados"  # Contador incrementado por toda importação que altera dados
+    id = Column(Integer, primary_key=True)
+    versao = Column(Integer)
+
+class CacheRelatorio(Base):
+    __tablename__ = "cache_relatorios"  # Relatório já gerado para (anos, formato, versão dos dados)
+    chave = Column(String, primary_key=True)
+    filename = Column(String, index=True)
+    ultimo_acesso = Column(DateTime)
+
+class Job(Base):
+    __tablename__ = "jobs"
+    id = Column(String, primary_key=True)
+    tipo = Column(String, index=True)  # upload | gerar
+    status = Column(String)            # pendente | executando | concluido | erro
+    progresso = Column(Text)           # JSON: arquivos lidos, itens/linhas gravados
+    resultado = Column(Text)           # JSON com o mesmo retorno das rotas síncronas
+    erro = Column(Text)
+    criado_em = Column(DateTime)
+    atualizado_em = Column(DateTime)
+
+class UploadSessao(Base):
+    # Upload em partes de um ZIP grande: o arquivo cresce em UPLOAD_DIR e pode ser retomado do ponto `recebido`
+    __tablename__ = "upload_sessoes"
+    id = Column(String, primary_key=True)
+    nome = Column(String)
+    tamanho = Column(BigInteger)
+    recebido = Column(BigInteger)
+    sha256 = Column(String)        # do arquivo inteiro, opcional (conferido ao concluir)
+    status = Column(String)        # recebendo | recebido | erro | cancelado
+    importado = Column(Integer)    # 1 quando o job terminou de importar o arquivo inteiro
+    job_id = Column(String)
+    erro = Column(Text)
+    criado_em = Column(DateTime)
+    atualizado_em = Column(DateTime, index=True)
+
+# --- DEFINIÇÃO ESTRITA DAS COLUNAS (ORDEM SOLICITADA) ---
+# (coluna no banco, coluna no relatório)
+CAMPOS_RELATORIO = [
+    ('mes', 'Mês'), ('ano', 'Ano'), ('chave_acesso', 'Chave Acesso NFe'),
+    ('inscricao_destinatario', 'Inscrição Destinatário'), ('inscricao_emitente', 'Inscrição Emitente'),
+    ('razao_social_emitente', 'Razão Social Emitente'), ('cnpj_emitente', 'Cnpj Emitente'),
+    ('uf_emitente', 'UF Emitente'), ('nr_nfe', 'Nr NFe'), ('serie', 'Série'), ('data_nfe', 'Data NFe'),
+    ('bc_icms_total', 'BC ICMS Total'), ('icms_total', 'ICMS Total'), ('bc_st_total', 'BC ST Total'),
+    ('icms_st_total', 'ICMS ST Total'), ('desc_total', 'Desc Total'), ('ipi_total', 'IPI Total'),
+    ('total_produtos', 'Total Produtos'), ('total_nfe', 'Total NFe'),
+    ('descricao_produto', 'Descrição Produto NFe'), ('ncm', 'NCM na NFe'), ('cst', 'CST'), ('cfop', 'CFOP NFe'),
+    ('qtde', 'Qtde'), ('unid', 'Unid'), ('vr_unit', 'Vr Unit'), ('vr_total', 'Vr Total'),
+    ('desconto_item', 'Desconto Item'), ('bc_icms', 'Base de Cálculo ICMS'), ('aliq_icms', 'Aliq ICMS'),
+    ('vr_icms', 'Vr ICMS'), ('aliq_ipi', 'Aliq IPI'), ('vr_ipi', 'Vr IPI'),
+]
+# Ordem das linhas gravadas na notas_fiscais_v7
+COLUNAS_NFE = ['chave_item'] + [c for c, _ in CAMPOS_RELATORIO] + ['cnpj_destinatario']
+IDX = {c: i for i, c in enumerate(COLUNAS_NFE)}
+
+# Nota extraída pelo parser: o cabeçalho (mês até total_nfe) fica uma vez só por nota e cada item guarda
+# só os campos do item. A linha completa (COLUNAS_NFE) é montada na hora de gravar, uma de cada vez.
+N_CAB = IDX['descricao_produto'] - 1
+I_CAB = {c: IDX[c] - 1 for c, _ in CAMPOS_RELATORIO[:N_CAB]}
+I_ITEM = {c: IDX[c] - 1 - N_CAB for c, _ in CAMPOS_RELATORIO[N_CAB:]}
+Nota = namedtuple('Nota', 'cab itens cnpj_destinatario')
+
+def iter_linhas(notas):
+    for cab, itens, cnpj_dest in notas:
+        chave = cab[I_CAB['chave_acesso']]
+        for i, it in enumerate(itens, 1):
+            yield (f"{chave}-{i}", *cab, *it, cnpj_dest)
+
+@contextmanager
+def trava_inicializacao():
+    # Os workers sobem juntos: um de cada vez cria tabelas/índices e recalcula resumos
+    # (advisory lock no Postgres; nos outros bancos, flock num arquivo local)
+    if engine.dialect.name != 'postgresql':
+        with open(os.path.join(UPLOAD_DIR, '.inicializacao.lock'), 'w') as f:
+            if fcntl is not None: fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+        return
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(74290117)"))
+        try: yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(74290117)"))
+            conn.commit()
+
+with trava_inicializacao():
+    Base.metadata.create_all(bind=engine)
+    # create_all não mexe em tabela que já existe: índices novos entram aqui
+    for _ix in NFe.__table__.indexes: _ix.create(bind=engine, checkfirst=True)
+    # Base de antes da documentos_hashes: começa com o hash atual de cada nota
+    with engine.begin() as _conn:
+        if _conn.scalar(select(HashDocumento.hash).limit(1)) is None:
+            _conn.execute(insert(HashDocumento).from_select(['hash', 'chave_acesso'], select(Documento.hash, Documento.chave_acesso)))
+
+# --- FUNÇÕES ---
+def iter_xmls(z):
+    # Lê os XMLs direto do ZIP em memória (sem extrair para disco), descendo em ZIPs aninhados
+    for info in z.infolist():
+        if info.is_dir(): continue
+        nome = info.filename.lower()
+        if nome.endswith('.xml'):
+            yield info.filename, z.read(info)
+        elif nome.endswith('.zip'):
+            try:
+                with zipfile.ZipFile(io.BytesIO(z.read(info))) as sub:
+                    yield from iter_xmls(sub)
+            except zipfile.BadZipFile: continue
+
+def ler_zips(fontes):
+    for fonte in fontes:
+        try:
+            with zipfile.ZipFile(fonte, 'r') as z:
+                yield from iter_xmls(z)
+        except zipfile.BadZipFile: continue
+
+# --- ZIP EM STREAMING ---
+# O diretório central do ZIP fica no fim do arquivo; para ler um ZIP que ainda está chegando, os membros
+# são lidos na ordem pelos cabeçalhos locais (stored/deflate, com ou sem data descriptor e zip64),
+# conferindo o CRC de cada um.
+ASS_LOCAL, ASS_CENTRAL, ASS_DESCRITOR = 0x04034b50, 0x02014b50, 0x08074b50
+CABECALHO_LOCAL = struct.Struct('<IHHHHHIIIHH')
+PEDACO_ZIP = 1024 * 1024
+
+class _Leitor:
+    # Leitura exata de n bytes sobre um arquivo, com devolução do que o zlib leu a mais
+    def __init__(self, f):
+        self.f, self.sobra = f, b''
+
+    def ler(self, n, exato=True):
+        b, self.sobra = self.sobra[:n], self.sobra[n:]
+        if len(b) < n: b += self.f.read(n - len(b))
+        if exato and len(b) < n: raise zipfile.BadZipFile("ZIP truncado")
+        return b
+
+    def devolver(self, b):
+        self.sobra = b + self.sobra
+
+def _zip64(extra, usize, csize):
+    # Campo extra 0x0001: tamanhos de 8 bytes, só os que estão como 0xFFFFFFFF no cabeçalho
+    i = 0
+    while i + 4 <= len(extra):
+        tag, n = struct.unpack_from('<HH', extra, i)
+        if tag == 1:
+            d, j = extra[i + 4:i + 4 + n], 0
+            if usize == 0xFFFFFFFF: usize, j = struct.unpack_from('<Q', d, j)[0], j + 8
+            if csize == 0xFFFFFFFF: csize = struct.unpack_from('<Q', d, j)[0]
+            return usize, csize, True
+        i += 4 + n
+    return usize, csize, False
+
+def _ler_membro(r, metodo, csize, usize, descritor, zip64, guardar):
+    # Devolve (dados, crc calculado, crc do descritor ou None); com guardar=False só consome os bytes
+    crc, partes = 0, []
+    if descritor and metodo == 0:
+        raise zipfile.BadZipFile("ZIP sem tamanho no cabeçalho local (stored com data descriptor)")
+    if metodo == 8:
+        d = zlib.decompressobj(-15)
+        falta = None if descritor else csize
+        while not d.eof:
+            b = r.ler(PEDACO_ZIP if falta is None else min(PEDACO_ZIP, falta), exato=False)
+            if not b: raise zipfile.BadZipFile("ZIP truncado")
+            if falta is not None: falta -= len(b)
+            try: x = d.decompress(b)
+            except zlib.error as e: raise zipfile.BadZipFile(f"Dados comprimidos inválidos: {e}")
+            crc = zlib.crc32(x, crc)
+            if guardar: partes.append(x)
+        if d.unused_data: r.devolver(d.unused_data)
+    elif metodo == 0:
+        falta = csize
+        while falta:
+            x = r.ler(min(PEDACO_ZIP, falta))
+            falta -= len(x)
+            crc = zlib.crc32(x, crc)
+            if guardar: partes.append(x)
+    else: raise zipfile.BadZipFile(f"Método de compressão {metodo} não suportado no upload em partes")
+    crc_descritor = None
+    if descritor:
+        b = r.ler(4)
+        if struct.unpack('<I', b)[0] == ASS_DESCRITOR: b = r.ler(4)
+        crc_descritor = struct.unpack('<I', b)[0]
+        r.ler(16 if zip64 else 8)
+    return b''.join(partes), crc, crc_descritor
+
+def iter_zip_stream(f):
+    # Mesmo contrato do iter_xmls: (nome, bytes) dos XMLs, descendo em ZIPs aninhados
+    r = _Leitor(f)
+    while True:
+        b = r.ler(4, exato=False)
+        if len(b) < 4 or struct.unpack('<I', b)[0] == ASS_CENTRAL: return
+        if struct.unpack('<I', b)[0] != ASS_LOCAL: raise zipfile.BadZipFile("Cabeçalho local inválido")
+        _, _, flags, metodo, _, _, crc, csize, usize, n_nome, n_extra = CABECALHO_LOCAL.unpack(b + r.ler(CABECALHO_LOCAL.size - 4))
+        nome = r.ler(n_nome).decode('utf-8' if flags & 0x800 else 'cp437')
+        usize, csize, zip64 = _zip64(r.ler(n_extra), usize, csize)
+        if flags & 1: raise zipfile.BadZipFile(f"{nome}: ZIP criptografado")
+        minusculo = nome.lower()
+        guardar = not nome.endswith('/') and minusculo.endswith(('.xml', '.zip'))
+        dados, crc_calc, crc_descritor = _ler_membro(r, metodo, csize, usize, flags & 8, zip64, guardar)
+        if crc_descritor is not None: crc = crc_descritor
+        if crc_calc != crc: raise zipfile.BadZipFile(f"{nome}: CRC não confere")
+        if not guardar: continue
+        if minusculo.endswith('.xml'): yield nome, dados
+        else:
+            try:
+                with zipfile.ZipFile(io.BytesIO(dados)) as sub:
+                    yield from iter_xmls(sub)
+            except zipfile.BadZipFile: continue
+
+# --- MÉTRICAS ---
+# Tempos por etapa e contadores da importação e dos relatórios: expostos em /metrics (formato texto do
+# Prometheus) e num log JSON por execução. Os valores são deste processo; com vários workers, cada um tem os seus.
+log = logging.getLogger("nfe")
+if not log.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(_handler)
+    log.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+    log.propagate = False
+
+job_atual = ContextVar('job_atual', default=None)  # id do job em execução, para os logs
+
+METRICAS = {
+    'nfe_xml_lidos_total': ('counter', 'XMLs lidos dos ZIPs'),
+    'nfe_xml_bytes_total': ('counter', 'Bytes de XML descompactados'),
+    'nfe_xml_ignorados_total': ('counter', 'XMLs ignorados por já estarem importados'),
+    'nfe_xml_falhas_total': ('counter', 'XMLs que falharam no parse'),
+    'nfe_notas_gravadas_total': ('counter', 'Notas gravadas, por resultado'),
+    'nfe_itens_gravados_total': ('counter', 'Itens gravados no banco'),
+    'nfe_importacao_etapa_segundos_total': ('counter', 'Tempo acumulado por etapa da importação'),
+    'nfe_importacao_segundos': ('summary', 'Duração das importações'),
+    'nfe_relatorio_linhas_total': ('counter', 'Linhas exportadas, por formato'),
+    'nfe_relatorio_cache_total': ('counter', 'Pedidos de relatório atendidos pelo cache ou gerados'),
+    'nfe_relatorio_etapa_segundos_total': ('counter', 'Tempo acumulado por etapa do relatório'),
+    'nfe_relatorio_segundos': ('summary', 'Duração da geração de relatórios'),
+    'nfe_jobs_finalizados_total': ('counter', 'Jobs finalizados, por tipo e status'),
+    'nfe_jobs': ('gauge', 'Jobs deste processo, por tipo e estado'),
+}
+_metricas = {}
+_metricas_lock = threading.Lock()
+
+def contar(nome, valor=1, **rotulos):
+    chave = (nome, tuple(sorted(rotulos.items())))
+    with _metricas_lock: _metricas[chave] = _metricas.get(chave, 0) + valor
+
+def definir(nome, valor, **rotulos):
+    with _metricas_lock: _metricas[(nome, tuple(sorted(rotulos.items())))] = valor
+
+def observar(nome, segundos, **rotulos):
+    contar(nome + '_sum', segundos, **rotulos)
+    contar(nome + '_count', 1, **rotulos)
+
+@contextmanager
+def cronometro(tempos, etapa):
+    ini = time.perf_counter()
+    try: yield
+    finally: tempos[etapa] = tempos.get(etapa, 0.0) + time.perf_counter() - ini
+
+def cronometrar(iteravel, tempos, etapa):
+    # Conta em tempos[etapa] só o tempo gasto produzindo cada item, não o de quem consome
+    it = iter(iteravel)
+    while True:
+        with cronometro(tempos, etapa):
+            try: x = next(it)
+            except StopIteration: return
+        yield x
+
+def registrar(evento, metrica, segundos, tempos, **dados):
+    # Fecha uma execução: acumula os tempos por etapa e grava uma linha de log JSON
+    for etapa, t in tempos.items(): contar(metrica + '_etapa_segundos_total', t, etapa=etapa)
+    log.info(json.dumps({'evento': evento, 'job': job_atual.get(), 'segundos': round(segundos, 3),
+                         'etapas': {k: round(v, 3) for k, v in tempos.items()}, **dados}, ensure_ascii=False))
+
+def _valor(v):
+    return round(v, 6) if isinstance(v, float) else v
+
+def texto_metricas():
+    with _metricas_lock: valores = sorted(_metricas.items())
+    linhas = []
+    for nome, (tipo, ajuda) in METRICAS.items():
+        linhas += [f"# HELP {nome} {ajuda}", f"# TYPE {nome} {tipo}"]
+        series = (nome + '_sum', nome + '_count') if tipo == 'summary' else (nome,)
+        for (n, rotulos), v in valores:
+            if n not in series: continue
+            r = ','.join(f'{k}="{v}"' for k, v in rotulos)
+            linhas.append(f"{n}{{{r}}} {_valor(v)}" if r else f"{n} {_valor(v)}")
+    return '\n'.join(linhas) + '\n'
+
+# --- EXTRATOR (passada única) ---
+# O XML é lido uma vez com iterparse: cada <det> é processado quando termina (campos caem num
+# mapa pré-computado) e liberado em seguida; o cabeçalho (ide/emit/dest/totais) é lido uma vez por nota.
+NFE_NS = '{http://www.portalfiscal.inf.br/nfe}'
+TAG_INF, TAG_DET = NFE_NS + 'infNFe', NFE_NS + 'det'
+
+def _mapa(campos, ns=True, sem_ns=True):
+    # Tag com namespace da NF-e -> campo; sem namespace -> '~campo' (só vale se não houver a primeira)
+    m = {NFE_NS + tag: c for tag, c in campos.items()} if ns else {}
+    if sem_ns: m.update({tag: '~' + c for tag, c in campos.items()})
+    return m
+
+MAPA_PROD = _mapa({'xProd': 'Descrição Produto NFe', 'NCM': 'NCM na NFe', 'CFOP': 'CFOP NFe', 'qCom': 'Qtde',
+                   'uCom': 'Unid', 'vUnCom': 'Vr Unit', 'vProd': 'Vr Total', 'vDesc': 'Desconto Item'})
+# CST pode estar em vários lugares (ICMS00, ICMS10, CSOSN101, etc): busca em qualquer nível do <imposto>
+MAPA_CST = _mapa({'CST': 'CST', 'CSOSN': 'CSOSN'})
+# No ICMS/IPI o caminho sem namespace só vale dentro de um grupo também sem namespace
+CAMPOS_ICMS = {'vBC': 'Base de Cálculo ICMS', 'pICMS': 'Aliq ICMS', 'vICMS': 'Vr ICMS'}
+CAMPOS_IPI = {'pIPI': 'Aliq IPI', 'vIPI': 'Vr IPI'}
+MAPA_ICMS, MAPA_ICMS_SEM = _mapa(CAMPOS_ICMS, sem_ns=False), _mapa(CAMPOS_ICMS, ns=False)
+MAPA_IPI, MAPA_IPI_SEM = _mapa(CAMPOS_IPI, sem_ns=False), _mapa(CAMPOS_IPI, ns=False)
+
+def _campos(elementos, mapa, d):
+    # Vale sempre o primeiro elemento encontrado (mesma regra do find)
+    for e in elementos:
+        c = mapa.get(e.tag)
+        if c is not None and c not in d: d[c] = e.text
+
+def _val(d, c):
+    return d[c] if c in d else d.get('~' + c)
+
+def _get(node, path):
+    # Caminho com namespace da NF-e; sem namespace só como alternativa
+    if node is None: return None
+    r = node.find(path.replace('nfe:', NFE_NS))
+    if r is None: r = node.find(path.replace('nfe:', ''))
+    return None if r is None else r.text
+
+def _txt(v):
+    # Mantém o comportamento antigo: vírgula vira ponto também nos textos
+    return v.replace(',', '.') if v else ""
+
+def _num(v):
+    try: return float(v.replace(',', '.')) if v else 0.0
+    except ValueError: return 0.0
+
+def _ler_det(det):
+    it = {}
+    prod = det.find(NFE_NS + 'prod')
+    imposto = det.find(NFE_NS + 'imposto')
+    if prod is not None: _campos(prod, MAPA_PROD, it)
+    if imposto is not None:
+        _campos(imposto.iter(), MAPA_CST, it)
+        # Valores do ICMS/IPI do item (busca profunda)
+        for icms in imposto.iter(NFE_NS + 'ICMS'): _campos(icms.iter(), MAPA_ICMS, it)
+        for icms in imposto.iter('ICMS'): _campos(icms.iter(), MAPA_ICMS_SEM, it)
+        for ipi in imposto.iter(NFE_NS + 'IPI'): _campos(ipi.iter(), MAPA_IPI, it)
+        for ipi in imposto.iter('IPI'): _campos(ipi.iter(), MAPA_IPI_SEM, it)
+    return it
+
+def parse_xml(dados):
+    # Linhas completas da nota; arquivo que não pôde ser lido vira lista vazia
+    # (a importação usa extrair_nfe e conta as falhas)
+    try: nota = extrair_nfe(dados)
+    except Exception: return []
+    return list(iter_linhas([nota])) if nota else []
+
+def extrair_nfe(dados):
+    dets = {}
+    root = None
+    for ev, el in ET.iterparse(io.BytesIO(dados)):
+        if el.tag == TAG_DET:
+            # Item completo: extrai e libera a subárvore
+            dets[el] = _ler_det(el)
+            el.clear()
+        root = el  # o último elemento fechado é a raiz
+    if 'nfeProc' in root.tag: inf = root.find('.//' + TAG_INF)
+    else: inf = root.find(TAG_INF)
+    if inf is None: return None
+
+    ide = inf.find(NFE_NS + 'ide')
+    emit = inf.find(NFE_NS + 'emit')
+    dest = inf.find(NFE_NS + 'dest')
+    total = inf.find('.//' + NFE_NS + 'ICMSTot')
+    prot = root.find('.//' + NFE_NS + 'infProt')
+    itens = [dets[det] for det in inf.findall(TAG_DET)]
+
+    chave = _txt(_get(prot, 'nfe:chNFe')) or inf.attrib.get('Id', '')[3:]
+    dt_str = _txt(_get(ide, 'nfe:dhEmi')) or _txt(_get(ide, 'nfe:dEmi'))
+    dt = datetime.now()
+    if len(dt_str) >= 10: dt = datetime.strptime(dt_str[:10], '%Y-%m-%d')
+    ano, mes = str(dt.year), str(dt.month).zfill(2)
+    cnpj_emit = _txt(_get(emit, 'nfe:CNPJ'))
+    cnpj_dest = _txt(_get(dest, 'nfe:CNPJ'))
+
+    # Cabeçalho resolvido uma vez por nota (mesma ordem de CAMPOS_RELATORIO)
+    cab = (
+        mes, ano, chave,
+        _txt(_get(dest, 'nfe:IE')),
+        _txt(_get(emit, 'nfe:IE')),
+        _txt(_get(emit, 'nfe:xNome')),
+        cnpj_emit,
+        _txt(_get(emit, 'nfe:enderEmit/nfe:UF')),
+        _txt(_get(ide, 'nfe:nNF')),
+        _txt(_get(ide, 'nfe:serie')),
+        dt.date(),
+    ) + tuple(_num(_get(total, 'nfe:' + tag)) for tag in ('vBC', 'vICMS', 'vBCST', 'vST', 'vDesc', 'vIPI', 'vProd', 'vNF'))
+
+    # Tuplas simples (e não objetos ORM) para poder voltar do processo filho via pickle
+    itens_nota = []
+    for it in itens:
+        itens_nota.append((
+            _txt(_val(it, 'Descrição Produto NFe')),
+            _txt(_val(it, 'NCM na NFe')),
+            _txt(_val(it, 'CST')) or _txt(_val(it, 'CSOSN')),  # CSOSN se for Simples Nacional
+            _txt(_val(it, 'CFOP NFe')),
+            _num(_val(it, 'Qtde')),
+            _txt(_val(it, 'Unid')),
+            _num(_val(it, 'Vr Unit')),
+            _num(_val(it, 'Vr Total')),
+            _num(_val(it, 'Desconto Item')),
+            _num(_val(it, 'Base de Cálculo ICMS')),
+            _num(_val(it, 'Aliq ICMS')),
+            _num(_val(it, 'Vr ICMS')),
+            _num(_val(it, 'Aliq IPI')),
+            _num(_val(it, 'Vr IPI')),
+        ))
+    return Nota(cab, itens_nota, cnpj_dest)
+
+# --- GRAVAÇÃO EM LOTE ---
+# Linhas vão para o banco em lotes com INSERT ... ON CONFLICT (sem o SELECT por linha do merge),
+# com commit a cada lote. Em cargas muito grandes no Postgres o lote entra via COPY numa tabela de staging.
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "5000"))
+COPY_MIN_ROWS = int(os.getenv("COPY_MIN_ROWS", "100000"))  # a partir daqui a importação passa a usar COPY
+
+def upsert(sess, modelo, valores, somar=()):
+    # INSERT ... ON CONFLICT (chave primária) DO UPDATE no Postgres e no SQLite; nos outros bancos, merge.
+    # Colunas em `somar` são acumuladas no valor existente em vez de substituídas.
+    # Linhas na ordem da chave primária: duas transações que tocam as mesmas linhas travam na mesma ordem
+    # (sem isso, duas importações simultâneas podem entrar em deadlock no Postgres)
+    tabela = modelo.__table__
+    dialeto = sess.bind.dialect.name
+    pk = [c.name for c in tabela.primary_key]
+    valores = sorted(valores, key=lambda v: tuple(str(v[c]) for c in pk))
+    if dialeto not in ('postgresql', 'sqlite'):
+        for v in valores:
+            atual = sess.get(modelo, tuple(v[c] for c in pk)) if somar else None
+            if atual is not None: v = {**v, **{c: (getattr(atual, c) or 0) + v[c] for c in somar}}
+            sess.merge(modelo(**v))
+        return
+    ins = (pg_insert if dialeto == 'postgresql' else sqlite_insert)(tabela)
+    sess.execute(ins.on_conflict_do_update(
+        index_elements=pk,
+        set_={c: (tabela.c[c] + ins.excluded[c]) if c in somar else ins.excluded[c] for c in valores[0] if c not in pk}
+    ), valores)
+
+_COLS_NFE = ', '.join(COLUNAS_NFE)
+_SETS_NFE = ', '.join(f"{c} = EXCLUDED.{c}" for c in COLUNAS_NFE[1:])
+
+def upsert_lote(sess, linhas):
+    # executemany posicional direto no driver: as tuplas vão para o banco sem virar dict por linha
+    dialeto = sess.bind.dialect.name
+    if dialeto not in ('postgresql', 'sqlite'): return upsert(sess, NFe, [dict(zip(COLUNAS_NFE, l)) for l in linhas])
+    sql = f"INSERT INTO {NFe.__tablename__} ({_COLS_NFE}) VALUES %s ON CONFLICT (chave_item) DO UPDATE SET {_SETS_NFE}"
+    cur = sess.connection().connection.cursor()
+    if dialeto == 'postgresql':
+        from psycopg2.extras import execute_values
+        execute_values(cur, sql, linhas, page_size=1000)
+    else:
+        cur.executemany(sql.replace('%s', f"({', '.join('?' * len(COLUNAS_NFE))})"), linhas)
+
+def copy_lote(sess, linhas):
+    # COPY para staging temporária + um único INSERT ... SELECT ... ON CONFLICT
+    tabela = NFe.__tablename__
+    cols, sets = _COLS_NFE, _SETS_NFE
+    cur = sess.connection().connection.cursor()
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {tabela}_stage (LIKE {tabela}) ON COMMIT DELETE ROWS")
+    buf = io.StringIO()
+    csv.writer(buf, quoting=csv.QUOTE_ALL).writerows(linhas)  # QUOTE_ALL: '' continua string vazia, não NULL
+    buf.seek(0)
+    cur.copy_expert(f"COPY {tabela}_stage ({cols}) FROM STDIN WITH (FORMAT csv)", buf)
+    cur.execute(f"INSERT INTO {tabela} ({cols}) SELECT {cols} FROM {tabela}_stage ORDER BY chave_item "
+                f"ON CONFLICT (chave_item) DO UPDATE SET {sets}")
+    cur.execute(f"TRUNCATE {tabela}_stage")
+
+def _gravar_linhas(sess, linhas, usar_copy):
+    if usar_copy and sess.bind.dialect.name == 'postgresql': copy_lote(sess, linhas)
+    else: upsert_lote(sess, linhas)
+
+def gravar_lote(sess, linhas, usar_copy=False):
+    # Chave repetida no mesmo lote: vale a última (ON CONFLICT não aceita a mesma linha duas vezes)
+    linhas = list({l[0]: l for l in linhas}.values())
+    if linhas: _gravar_linhas(sess, linhas, usar_copy)
+    return len(linhas)
+
+def gravar_notas(sess, notas, usar_copy=False):
+    # Notas distintas nunca repetem chave_item: as linhas saem do gerador direto para o driver
+    n = sum(len(nota.itens) for nota in notas)
+    if n: _gravar_linhas(sess, iter_linhas(notas), usar_copy)
+    return n
+
+COLUNAS_GRUPO = ('ano', 'mes', 'cnpj_emitente', 'cnpj_destinatario')
+
+def _resumo_nota(nota):
+    cab, itens = nota.cab, nota.itens
+    i_total = I_ITEM['vr_total']
+    return {'chave_acesso': cab[I_CAB['chave_acesso']], 'ano': cab[I_CAB['ano']], 'mes': cab[I_CAB['mes']],
+            'cnpj_emitente': cab[I_CAB['cnpj_emitente']], 'cnpj_destinatario': nota.cnpj_destinatario,
+            'qtd_itens': len(itens), 'total_nfe': cab[I_CAB['total_nfe']] or 0,
+            'total_itens': sum(it[i_total] or 0 for it in itens)}
+
+def travar_resumos(sess):
+    # Resumos e facetas somam a diferença contra a versão anterior das notas: ler essa versão e aplicar a diferença
+    # tem de ser exclusivo entre importações (threads e workers), senão duas importações da mesma nota a contam duas
+    # vezes. A trava é o próprio incremento de versao_dados, feito antes da leitura: no Postgres prende a linha até o
+    # commit; no SQLite abre a transação já com a trava de escrita do banco (o pysqlite só abre a transação na
+    # primeira escrita, e o que foi lido antes dela pode estar velho quando a diferença é gravada).
+    upsert(sess, VersaoDados, [{'id': 1, 'versao': 1}], somar=('versao',))
+
+def atualizar_resumos(sess, novos, antigos):
+    # Aplica a diferença (notas novas menos a versão anterior das notas alteradas) nos totais mensais
+    grupos = {}
+    for r, sinal in [(r, 1) for r in novos] + [(r, -1) for r in antigos]:
+        g = grupos.setdefault(tuple(r[c] for c in COLUNAS_GRUPO), [0, 0, 0.0, 0.0])
+        g[0] += sinal
+        g[1] += sinal * r['qtd_itens']
+        g[2] += sinal * r['total_nfe']
+        g[3] += sinal * r['total_itens']
+    if not grupos: return
+    upsert(sess, ResumoMensal, [
+        {**dict(zip(COLUNAS_GRUPO, k)), 'qtd_notas': v[0], 'qtd_itens': v[1], 'total_notas': v[2], 'total_itens': v[3]}
+        for k, v in grupos.items()
+    ], somar=('qtd_notas', 'qtd_itens', 'total_notas', 'total_itens'))
+    sess.execute(delete(ResumoMensal).where(ResumoMensal.qtd_notas <= 0))
+    upsert(sess, ResumoNota, novos)
+
+# Dimensões das facetas -> coluna do item
+DIMENSOES = {'emitente': 'cnpj_emitente', 'destinatario': 'cnpj_destinatario', 'cfop': 'cfop', 'ncm': 'ncm', 'uf': 'uf_emitente'}
+COLUNAS_FACETA = ('chave_acesso', 'ano', 'mes', 'razao_social_emitente', *DIMENSOES.values())
+faceta_da_linha = itemgetter(*[IDX[c] for c in COLUNAS_FACETA])
+
+def _facetas(itens, nomes):
+    # itens: tuplas na ordem de COLUNAS_FACETA -> {(dimensao, valor, ano, mes): [qtd_notas, qtd_itens]}
+    f, vistos = {}, set()
+    for chave, ano, mes, nome, *valores in itens:
+        nomes[valores[0]] = nome
+        for dim, v in zip(DIMENSOES, valores):
+            k = (dim, v or '', ano, mes)
+            c = f.setdefault(k, [0, 0])
+            c[1] += 1
+            if (chave, k) not in vistos:
+                vistos.add((chave, k))
+                c[0] += 1
+    return f
+
+def atualizar_facetas(sess, novas, antigas, nomes):
+    # Mesma conta por diferença dos resumos: só com travar_resumos feito antes de ler as facetas antigas
+    delta = {}
+    for f, sinal in ((novas, 1), (antigas, -1)):
+        for k, (n, i) in f.items():
+            d = delta.setdefault(k, [0, 0])
+            d[0] += sinal * n
+            d[1] += sinal * i
+    if not delta: return
+    upsert(sess, Faceta, [
+        {'dimensao': k[0], 'valor': k[1], 'ano': k[2], 'mes': k[3], 'descricao': nomes.get(k[1]) if k[0] == 'emitente' else None,
+         'qtd_notas': n, 'qtd_itens': i}
+        for k, (n, i) in delta.items()
+    ], somar=('qtd_notas', 'qtd_itens'))
+    sess.execute(delete(Faceta).where(Faceta.qtd_notas <= 0))
+
+def reconstruir_resumos(sess):
+    # Recalcula as tabelas de resumo a partir dos itens (bases antigas ou migradas)
+    # Trava antes de apagar: uma importação em curso aplicaria sua diferença por cima do que foi recontado
+    # (e travaria as tabelas na ordem inversa). Os itens mudaram por fora da importação: caches e dataset Parquet
+    # deixam de valer.
+    travar_resumos(sess)
+    sess.execute(delete(ResumoMensal))
+    sess.execute(delete(ResumoNota))
+    sess.execute(insert(ResumoNota).from_select(
+        ['chave_acesso', *COLUNAS_GRUPO, 'qtd_itens', 'total_nfe', 'total_itens'],
+        select(NFe.chave_acesso, func.min(NFe.ano), func.min(NFe.mes), func.min(NFe.cnpj_emitente),
+               func.min(NFe.cnpj_destinatario), func.count(), func.max(NFe.total_nfe), func.sum(NFe.vr_total))
+        .group_by(NFe.chave_acesso)))
+    sess.execute(insert(ResumoMensal).from_select(
+        [*COLUNAS_GRUPO, 'qtd_notas', 'qtd_itens', 'total_notas', 'total_itens'],
+        select(*[getattr(ResumoNota, c) for c in COLUNAS_GRUPO], func.count(), func.sum(ResumoNota.qtd_itens),
+               func.sum(ResumoNota.total_nfe), func.sum(ResumoNota.total_itens))
+        .group_by(*[getattr(ResumoNota, c) for c in COLUNAS_GRUPO])))
+    sess.execute(delete(Faceta))
+    for dim, c in DIMENSOES.items():
+        col = getattr(NFe, c)
+        sess.execute(insert(Faceta).from_select(
+            ['dimensao', 'valor', 'ano', 'mes', 'descricao', 'qtd_notas', 'qtd_itens'],
+            select(literal(dim), func.coalesce(col, ''), NFe.ano, NFe.mes,
+                   func.max(NFe.razao_social_emitente) if dim == 'emitente' else null(),
+                   func.count(NFe.chave_acesso.distinct()), func.count())
+            .group_by(func.coalesce(col, ''), NFe.ano, NFe.mes)))
+    sess.commit()
+
+def gravar_documentos(sess, docs, stats, usar_copy=False, arquivo=None, hashes=None):
+    # docs: {chave_acesso: (hash, Nota)}. Itens, índice de documentos e resumos entram na mesma transação.
+    # hashes: {hash: chave_acesso} de todos os XMLs lidos, inclusive os substituídos em docs por outro da mesma chave.
+    tempos = stats.setdefault('tempos', {})
+    docs = dict(sorted(docs.items()))  # itens gravados na ordem da chave, como os upserts (ver upsert)
+    # Trava do dataset antes da primeira escrita: esperar por ela com a transação aberta travaria o banco
+    # (no SQLite, o banco inteiro) enquanto um relatório ou o arquivar.py a segura
+    with trava_arquivo():
+        with cronometro(tempos, 'banco_consulta'):
+            travar_resumos(sess)  # também avisa que os dados mudaram: relatórios em cache deixam de valer
+            resumos_antigos = [{c: getattr(r, c) for c in ('chave_acesso', 'qtd_itens', 'total_nfe', 'total_itens', *COLUNAS_GRUPO)}
+                               for r in sess.scalars(select(ResumoNota).where(ResumoNota.chave_acesso.in_(list(docs))))]
+            antigos = [r['chave_acesso'] for r in resumos_antigos]
+            nomes = {}
+            facetas_antigas = _facetas(sess.execute(select(*[getattr(NFe, c) for c in COLUNAS_FACETA])
+                                                    .where(NFe.chave_acesso.in_(antigos))), nomes) if antigos else {}
+        with cronometro(tempos, 'banco_itens'):
+            # Nota que já estava no banco: apaga os itens antigos (a quantidade de itens pode ter mudado)
+            if antigos: sess.execute(delete(NFe).where(NFe.chave_acesso.in_(antigos)))
+            stats['itens'] += gravar_notas(sess, [nota for _, nota in docs.values()], usar_copy)
+        with cronometro(tempos, 'banco_resumos'):
+            agora = datetime.now()
+            upsert(sess, Documento, [{'chave_acesso': chave, 'hash': h, 'qtd_itens': len(nota.itens), 'importado_em': agora}
+                                     for chave, (h, nota) in docs.items()])
+            hashes = hashes or {h: chave for chave, (h, _) in docs.items()}
+            upsert(sess, HashDocumento, [{'hash': h, 'chave_acesso': chave} for h, chave in hashes.items()])
+            atualizar_resumos(sess, [_resumo_nota(nota) for _, nota in docs.values()], resumos_antigos)
+            novas = _facetas(map(faceta_da_linha, iter_linhas(nota for _, nota in docs.values())), nomes)
+            atualizar_facetas(sess, novas, facetas_antigas, nomes)
+        with cronometro(tempos, 'banco_commit'): sess.commit()
+        if arquivo:
+            # O banco é a fonte: falha no dataset só o deixa fora de sincronia (relatórios voltam a ler do banco)
+            with cronometro(tempos, 'arquivo'): arquivo.registrar(sess, docs, resumos_antigos)
+    stats['atualizados'] += len(antigos)
+    stats['novos'] += len(docs) - len(antigos)
+
+# --- PROCESSAMENTO PARALELO ---
+# O parse roda num pool de processos (um por núcleo por padrão), em lotes de XMLs
+# Com vários workers web (WEB_CONCURRENCY) cada um tem seu pool: os núcleos são divididos entre eles
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", max(1, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", "1")))))
+PARSE_BATCH = int(os.getenv("PARSE_BATCH", "200"))
+_pool = None
+
+def get_pool():
+    global _pool
+    if _pool is None: _pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    return _pool
+
+@app.on_event("shutdown")
+def fechar_pool():
+    if _pool is not None: _pool.shutdown(cancel_futures=True)
+
+def parse_lote(lote):
+    # Executado no processo filho: recebe (nome, hash, bytes) dos XMLs e devolve uma Nota por documento,
+    # com o erro de quem falhou e o tempo gasto no lote
+    ini = time.perf_counter()
+    res = []
+    for nome, h, dados in lote:
+        try: res.append((nome, h, extrair_nfe(dados), None))
+        except Exception as e: res.append((nome, h, None, f"{type(e).__name__}: {e}"))
+    return res, time.perf_counter() - ini
+
+def iter_lotes(xmls, stats):
+    # Os XMLs vêm direto do ZIP, da memória para o parser. No upload em partes o unzip inclui a espera pelos bytes.
+    lote = []
+    tempos = stats['tempos']
+    for nome, dados in cronometrar(xmls, tempos, 'unzip'):
+        stats['arquivos'] += 1
+        stats['bytes'] += len(dados)
+        with cronometro(tempos, 'hash'): h = hashlib.sha256(dados).hexdigest()
+        lote.append((nome, h, dados))
+        if len(lote) >= PARSE_BATCH:
+            yield lote
+            lote = []
+    if lote: yield lote
+
+def filtrar_conhecidos(sess, lote, vistos, stats):
+    # XML idêntico a um já importado (ou repetido neste upload) nem vai para o parser
+    conhecidos = set(sess.scalars(select(HashDocumento.hash).where(HashDocumento.hash.in_([h for _, h, _ in lote]))))
+    novos = []
+    for nome, h, dados in lote:
+        if h in conhecidos or h in vistos:
+            stats['ignorados'] += 1
+            continue
+        vistos.add(h)
+        novos.append((nome, h, dados))
+    return novos
+
+def importar_zips(fontes, progresso=None):
+    return importar_xmls(ler_zips(fontes), progresso)
+
+def importar_xmls(xmls, progresso=None):
+    # xmls: (nome, bytes) de cada XML, de ZIPs completos (ler_zips) ou chegando por upload em partes (iter_zip_stream)
+    global _pool
+    stats = {'arquivos': 0, 'bytes': 0, 'itens': 0, 'novos': 0, 'atualizados': 0, 'ignorados': 0, 'falhas': 0, 'tempos': {}}
+    tempos = stats['tempos']
+    ini = time.perf_counter()
+    sess = SessionLocal()
+    pool = get_pool()
+    # Limita os lotes em voo para a memória não crescer com o tamanho do upload
+    pendentes = deque()
+    vistos = set()
+    docs, hashes, n_linhas = {}, {}, 0
+    arquivo = ImportacaoArquivo() if ARQUIVO_DIR else None
+
+    def gravar(resultados, fim=False):
+        nonlocal docs, hashes, n_linhas
+        for nome, h, nota, erro in resultados:
+            if erro:
+                stats['falhas'] += 1
+                log.warning(json.dumps({'evento': 'falha_parse', 'job': job_atual.get(), 'arquivo': nome, 'erro': erro},
+                                       ensure_ascii=False))
+            if not nota or not nota.itens: continue
+            docs[nota.cab[I_CAB['chave_acesso']]] = (h, nota)
+            hashes[h] = nota.cab[I_CAB['chave_acesso']]
+            n_linhas += len(nota.itens)
+        if n_linhas >= DB_BATCH_SIZE or (fim and docs):
+            gravar_documentos(sess, docs, stats, usar_copy=stats['itens'] >= COPY_MIN_ROWS, arquivo=arquivo, hashes=hashes)
+            docs, hashes, n_linhas = {}, {}, 0
+        if progresso: progresso(stats)
+
+    def resultado():
+        # parse: tempo de CPU somado dos processos filhos; espera_parse: tempo parado aguardando por eles
+        with cronometro(tempos, 'espera_parse'): res, t = pendentes.popleft().result()
+        tempos['parse'] = tempos.get('parse', 0.0) + t
+        return res
+
+    status = 'erro'
+    try:
+        for lote in iter_lotes(xmls, stats):
+            with cronometro(tempos, 'dedup'): lote = filtrar_conhecidos(sess, lote, vistos, stats)
+            if lote: pendentes.append(pool.submit(parse_lote, lote))
+            while len(pendentes) >= PARSE_WORKERS * 2:
+                gravar(resultado())
+        while pendentes:
+            gravar(resultado())
+        gravar([], fim=True)
+        status = 'ok'
+        return stats
+    except Exception as e:
+        # Pool quebrado (processo filho morreu): descarta para recriar na próxima importação
+        if isinstance(e, BrokenProcessPool): _pool = None
+        sess.rollback()
+        raise
+    finally:
+        for f in pendentes: f.cancel()
+        sess.close()
+        if arquivo:
+            # Também quando a importação falha: os lotes já gravados no banco vão para o dataset
+            with cronometro(tempos, 'arquivo'): arquivo.finalizar()
+        registrar_importacao(stats, status, time.perf_counter() - ini)
+
+def registrar_importacao(stats, status, segundos):
+    contar('nfe_xml_lidos_total', stats['arquivos'])
+    contar('nfe_xml_bytes_total', stats['bytes'])
+    contar('nfe_xml_ignorados_total', stats['ignorados'])
+    contar('nfe_xml_falhas_total', stats['falhas'])
+    contar('nfe_notas_gravadas_total', stats['novos'], resultado='novo')
+    contar('nfe_notas_gravadas_total', stats['atualizados'], resultado='atualizado')
+    contar('nfe_itens_gravados_total', stats['itens'])
+    observar('nfe_importacao_segundos', segundos, status=status)
+    registrar('importacao', 'nfe_importacao', segundos, stats['tempos'], status=status,
+              **{k: v for k, v in stats.items() if k != 'tempos'})
+
+def resposta_importacao(stats):
+    msg = f"{stats['arquivos']} XMLs lidos: {stats['novos']} notas novas, {stats['atualizados']} atualizadas, " \
+          f"{stats['ignorados']} já importadas. {stats['itens']} itens processados."
+    if stats['falhas']: msg += f" {stats['falhas']} arquivos com erro de leitura."
+    return {
+        "ok": True,
+        "msg": msg,
+        "novos": stats['novos'],
+        "atualizados": stats['atualizados'],
+        "ignorados": stats['ignorados'],
+        "falhas": stats['falhas'],
+    }
+
+# --- FILTROS ---
+# Filtros do relatório viram condições no SQL (apoiadas pelos índices compostos da NFe). Valores múltiplos
+# vêm separados por vírgula; CFOP e NCM incompletos valem como prefixo ('5' = saídas dentro do estado,
+# '8471' = o capítulo inteiro). Período no formato AAAA-MM.
+FILTROS = ('anos', 'mes_de', 'mes_ate', 'cnpj_emitente', 'cnpj_destinatario', 'cfop', 'ncm', 'uf')
+FILTROS_PERIODO = {'anos', 'mes_de', 'mes_ate'}
+FILTROS_RESUMO = FILTROS_PERIODO | {'cnpj_emitente', 'cnpj_destinatario'}  # atendidos pelo resumo_mensal
+TAMANHO_CODIGO = {'cfop': 4, 'ncm': 8}
+
+def _lista(v, so_digitos=False):
+    itens = v.split(',') if isinstance(v, str) else v or []
+    itens = {''.join(filter(str.isdigit, x)) if so_digitos else x.strip().upper() for x in itens}
+    return sorted(x for x in itens if x)
+
+def normalizar_filtros(anos='', mes_de='', mes_ate='', cnpj_emitente='', cnpj_destinatario='', cfop='', ncm='', uf=''):
+    f = {'anos': _lista(anos), 'cnpj_emitente': _lista(cnpj_emitente, True), 'cnpj_destinatario': _lista(cnpj_destinatario, True),
+         'cfop': _lista(cfop, True), 'ncm': _lista(ncm, True), 'uf': _lista(uf)}
+    for k, v in (('mes_de', mes_de), ('mes_ate', mes_ate)):
+        v = (v or '').strip()
+        if not v: continue
+        if not re.fullmatch(r'\d{4}-(0[1-9]|1[0-2])', v): raise ValueError(f"Mês inválido: {v} (use AAAA-MM).")
+        f[k] = v
+    return {k: v for k, v in f.items() if v}
+
+def _prefixos(col, valores, tamanho):
+    # Prefixo vira faixa (>= '8471' e < '8472') em vez de LIKE: usa o índice em qualquer banco
+    return or_(*[col == v if len(v) >= tamanho else and_(col >= v, col < v[:-1] + chr(ord(v[-1]) + 1)) for v in valores])
+
+def condicoes(modelo, f):
+    c = []
+    if 'anos' in f: c.append(modelo.ano.in_(f['anos']))
+    if 'mes_de' in f: c.append(tuple_(modelo.ano, modelo.mes) >= tuple_(*f['mes_de'].split('-')))
+    if 'mes_ate' in f: c.append(tuple_(modelo.ano, modelo.mes) <= tuple_(*f['mes_ate'].split('-')))
+    if 'cnpj_emitente' in f: c.append(modelo.cnpj_emitente.in_(f['cnpj_emitente']))
+    if 'cnpj_destinatario' in f: c.append(modelo.cnpj_destinatario.in_(f['cnpj_destinatario']))
+    for k, tamanho in TAMANHO_CODIGO.items():
+        if k in f: c.append(_prefixos(getattr(modelo, k), f[k], tamanho))
+    if 'uf' in f: c.append(modelo.uf_emitente.in_(f['uf']))
+    return c
+
+def facetas(sess, f, limite=200):
+    # Valores disponíveis para os filtros, com contagens, das tabelas de resumo (sem DISTINCT sobre os itens)
+    m = ResumoMensal
+    periodo = {k: v for k, v in f.items() if k in FILTROS_PERIODO}
+    r = {
+        "anos": [a for a, in sess.execute(select(m.ano).group_by(m.ano).order_by(m.ano))],
+        "meses": [{"ano": a, "mes": mes, "qtd_notas": n} for a, mes, n in sess.execute(
+            select(m.ano, m.mes, func.sum(m.qtd_notas)).where(*condicoes(m, periodo)).group_by(m.ano, m.mes).order_by(m.ano, m.mes))],
+    }
+    for dim in DIMENSOES:
+        q = select(Faceta.valor, func.max(Faceta.descricao), func.sum(Faceta.qtd_notas), func.sum(Faceta.qtd_itens)) \
+            .where(Faceta.dimensao == dim, *condicoes(Faceta, periodo)) \
+            .group_by(Faceta.valor).order_by(func.sum(Faceta.qtd_notas).desc(), Faceta.valor).limit(limite)
+        r[dim] = [{"valor": v, "descricao": d, "qtd_notas": n, "qtd_itens": i} for v, d, n, i in sess.execute(q)]
+    return r
+
+# --- RESUMOS ---
+@app.on_event("startup")
+def preparar_resumos():
+    # Base com itens mas sem resumo ou facetas (importada antes dessas tabelas): recalcula uma vez
+    with trava_inicializacao():
+        sess = SessionLocal()
+        try:
+            vazio = sess.scalar(select(ResumoNota.chave_acesso).limit(1)) is None or sess.scalar(select(Faceta.valor).limit(1)) is None
+            if vazio and sess.scalar(select(NFe.chave_item).limit(1)) is not None:
+                reconstruir_resumos(sess)
+        finally: sess.close()
+
+def resumo_totais(sess, filtros, meu_cnpj):
+    cnpj_limpo = ''.join(filter(str.isdigit, meu_cnpj))
+    if set(filtros) <= FILTROS_RESUMO:
+        m, where = ResumoMensal, condicoes(ResumoMensal, filtros)
+        qtd, total_notas = m.qtd_notas, m.total_notas
+    else:
+        # Filtro por item (CFOP/NCM/UF): notas com algum item no filtro; o total dos itens soma só os que passam
+        m = select(NFe.chave_acesso, func.min(NFe.cnpj_emitente).label('cnpj_emitente'),
+                   func.min(NFe.cnpj_destinatario).label('cnpj_destinatario'), func.max(NFe.total_nfe).label('total_nfe'),
+                   func.sum(NFe.vr_total).label('total_itens')) \
+            .where(*condicoes(NFe, filtros)).group_by(NFe.chave_acesso).subquery().c
+        where, qtd, total_notas = [], literal(1), m.total_nfe
+    saida = m.cnpj_emitente == cnpj_limpo
+    entrada = (m.cnpj_emitente != cnpj_limpo) & (m.cnpj_destinatario == cnpj_limpo)
+    r = sess.execute(select(
+        func.coalesce(func.sum(qtd), 0), func.coalesce(func.sum(total_notas), 0),
+        func.coalesce(func.sum(m.total_itens), 0),
+        func.coalesce(func.sum(case((entrada, qtd), else_=0)), 0),
+        func.coalesce(func.sum(case((saida, qtd), else_=0)), 0),
+    ).where(*where)).one()
+    qtd_notas, v_notas, v_itens, entradas, saidas = r
+
+    # Resumo Entradas/Saidas (Apenas contagem visual)
+    resumo_msg = "Sem filtro de CNPJ"
+    if meu_cnpj: resumo_msg = f"Entradas: {entradas} | Saídas: {saidas}"
+    return {
+        "notas": f"R$ {v_notas:,.2f}",
+        "itens": f"R$ {v_itens:,.2f}",
+        "qtd_notas": qtd_notas,
+        "resumo_ops": resumo_msg,
+    }
+
+# --- EXPORTAÇÃO EM STREAMING ---
+# O relatório sai do banco por cursor do lado do servidor, já na ordem certa, e vai direto para o
+# arquivo em blocos: a memória fica constante, seja qual for o tamanho do relatório.
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "10000"))
+XLSX_MAX_LINHAS = 1048576  # limite de linhas por planilha do Excel (com o cabeçalho)
+FORMATOS = {'xlsx', 'csv', 'parquet'}
+
+ROTULOS = [rotulo for _, rotulo in CAMPOS_RELATORIO]
+N_COLS = len(ROTULOS)
+I_DATA = ROTULOS.index('Data NFe')
+
+# Itens do mesmo dia por nota e pelo número do item como número (chave_item é texto: o item 10 viria antes do 2).
+# chave_acesso em ordem binária (no Postgres a collation padrão segue o locale)
+ORDEM_ITENS = (NFe.data_nfe, NFe.chave_acesso.collate('C') if engine.dialect.name == 'postgresql' else NFe.chave_acesso,
+               cast(func.substr(NFe.chave_item, func.length(NFe.chave_acesso) + 2), Integer))
+
+def iter_relatorio(filtros):
+    q = select(*[getattr(NFe, c) for c, _ in CAMPOS_RELATORIO]) \
+        .where(*condicoes(NFe, filtros)) \
+        .order_by(NFe.ano, NFe.mes, *ORDEM_ITENS)
+    with engine.connect() as conn:
+        res = conn.execution_options(stream_results=True, yield_per=EXPORT_CHUNK).execute(q)
+        yield from res.partitions()
+
+def com_progresso(lotes, stats, progresso=None):
+    for lote in lotes:
+        stats['linhas'] += len(lote)
+        if progresso: progresso({'linhas': stats['linhas']})
+        yield lote
+
+def _como_texto(r):
+    r = list(r[:N_COLS])
+    if r[I_DATA]: r[I_DATA] = r[I_DATA].strftime('%d/%m/%Y')
+    return r
+
+def escrever_xlsx(filepath, lotes):
+    wb = Workbook(write_only=True)
+    ws, n = None, XLSX_MAX_LINHAS
+    for lote in lotes:
+        for r in lote:
+            # Chegou no limite do Excel: continua numa planilha nova
+            if n >= XLSX_MAX_LINHAS:
+                ws = wb.create_sheet(f"Sheet{len(wb.worksheets) + 1}")
+                ws.append([_cabecalho(ws, c) for c in ROTULOS])
+                n = 1
+            ws.append(_como_texto(r))
+            n += 1
+    if ws is None: wb.create_sheet("Sheet1").append(ROTULOS)
+    wb.save(filepath)
+
+def _cabecalho(ws, texto):
+    c = WriteOnlyCell(ws, value=texto)
+    c.font = Font(bold=True)
+    return c
+
+def escrever_csv(filepath, lotes):
+    with open(filepath, 'w', newline='', encoding='utf-8-sig') as f:
+        w = csv.writer(f, delimiter=';')
+        w.writerow(ROTULOS)
+        for lote in lotes: w.writerows(_como_texto(r) for r in lote)
+
+def _tipo_arrow(c):
+    return pa.date32() if c == 'data_nfe' else pa.float64() if isinstance(NFe.__table__.c[c].type, Numeric) else pa.string()
+
+SCHEMA_PARQUET = pa.schema([(rotulo, _tipo_arrow(c)) for c, rotulo in CAMPOS_RELATORIO])
+
+def escrever_parquet(filepath, lotes):
+    with pq.ParquetWriter(filepath, SCHEMA_PARQUET) as w:
+        for lote in lotes:
+            cols = list(zip(*(r[:N_COLS] for r in lote)))
+            w.write_table(pa.Table.from_arrays([pa.array(col, t.type) for col, t in zip(cols, SCHEMA_PARQUET)], schema=SCHEMA_PARQUET))
+
+ESCRITORES = {'xlsx': escrever_xlsx, 'csv': escrever_csv, 'parquet': escrever_parquet}
+
+# --- ARQUIVO PARQUET ---
+# Com ARQUIVO_DIR definido, as importações também gravam os itens num dataset Parquet particionado por
+# ano/mes/cnpj_emitente (partições hive: ano=2024/mes=03/cnpj_emitente=.../parte-*.parquet), para análise
+# fora do banco. Cada importação junta em memória (Arrow) o que já foi gravado no banco e descarrega no
+# dataset a cada ARQUIVO_LOTE linhas e no fim, juntando depois as partes pequenas de cada partição tocada.
+# Nota atualizada sai da partição antiga já no registro, com a trava (só as partes que a contêm são reescritas),
+# e nota do buffer que outra importação atualizou depois (hash em documentos mudou) é descartada ao descarregar:
+# o dataset nunca tem a mesma nota duas vezes. Toda parte é gravada ordenada por data, nota e número do item (_ordenar), a ordem do relatório.
+# _versao guarda a versão dos dados já coberta pelo dataset (avança junto com cada commit da importação) e
+# _pendentes/ tem uma entrada por importação com linhas ainda não descarregadas. Os relatórios só leem do
+# dataset com a versão igual à do banco e nada pendente; senão leem do banco. Falha ao gravar o dataset,
+# importação interrompida à força ou mudança nos itens por fora da importação (migração) o deixam fora de
+# sincronia até `python arquivar.py` reconstruí-lo.
+# Trava (trava_arquivo): a importação pega a exclusiva antes de escrever no banco e só solta depois do commit
+# e do registro no dataset, então nunca espera por ela com transação aberta. O relatório pega a compartilhada
+# só para conferir a versão e fazer hardlinks das partes que vai ler (_leituras/): a leitura em si corre solta.
+ARQUIVO_DIR = os.getenv("ARQUIVO_DIR", "")
+ARQUIVO_LOTE = int(os.getenv("ARQUIVO_LOTE", "200000"))  # linhas em memória por importação antes de descarregar
+ARQUIVO_PARTE_MB = int(os.getenv("ARQUIVO_PARTE_MB", "64"))  # partes maiores que isso não são mais reescritas
+# Relatório com menos itens que isso (estimado pelo resumo mensal) lê do banco: a consulta pelos índices sai mais
+# barata que abrir as partes. Os grandes, históricos, saem do dataset e não pesam no banco.
+ARQUIVO_MIN_ITENS = int(os.getenv("ARQUIVO_MIN_ITENS", "500000"))
+PARTICOES = ('ano', 'mes', 'cnpj_emitente')
+SEM_VALOR = '__HIVE_DEFAULT_PARTITION__'  # cnpj_emitente vazio (emitente pessoa física)
+SCHEMA_ARQUIVO = pa.schema([(c, _tipo_arrow(c)) for c in COLUNAS_NFE if c not in PARTICOES])
+PARTICIONAMENTO = ds.partitioning(pa.schema([(c, pa.string()) for c in PARTICOES]), flavor='hive')
+SCHEMA_DATASET = pa.schema(list(SCHEMA_ARQUIVO) + list(PARTICIONAMENTO.schema))
+ORDEM_ARQUIVO = [('data_nfe', 'ascending'), ('chave_acesso', 'ascending'), ('_item', 'ascending')]
+
+def _numero_item(chave_item):
+    return int(chave_item[chave_item.rfind('-') + 1:])
+
+def _ordenar(t):
+    # ORDEM_ITENS do banco: o número do item sai do fim da chave_item, como número
+    item = pc.cast(pc.struct_field(pc.extract_regex(t['chave_item'], r'-(?P<n>\d+)$'), [0]), pa.int64())
+    return t.take(pc.sort_indices(t.append_column('_item', item), ORDEM_ARQUIVO))
+
+@contextmanager
+def trava_arquivo(compartilhada=False):
+    # Escrita exclusiva, leitura compartilhada; flock vale entre threads e entre os workers
+    if not ARQUIVO_DIR:
+        yield
+        return
+    for d in ('_pendentes', '_leituras'): os.makedirs(os.path.join(ARQUIVO_DIR, d), exist_ok=True)
+    with open(os.path.join(ARQUIVO_DIR, '.trava'), 'a') as f:
+        if fcntl is not None: fcntl.flock(f, fcntl.LOCK_SH if compartilhada else fcntl.LOCK_EX)
+        yield
+
+def versao_dados(sess):
+    return sess.scalar(select(VersaoDados.versao).where(VersaoDados.id == 1)) or 0
+
+def versao_arquivo():
+    try:
+        with open(os.path.join(ARQUIVO_DIR, '_versao')) as f: return int(f.read())
+    except (FileNotFoundError, ValueError): return None
+
+def _gravar_versao(versao):
+    # None: dataset fora de sincronia, só o arquivar.py o traz de volta
+    caminho = os.path.join(ARQUIVO_DIR, '_versao')
+    if versao is None:
+        if os.path.exists(caminho): os.remove(caminho)
+        return
+    with open(caminho + '.tmp', 'w') as f: f.write(str(versao))
+    os.replace(caminho + '.tmp', caminho)
+
+def arquivo_em_dia(sess):
+    return versao_arquivo() == versao_dados(sess) and not os.listdir(os.path.join(ARQUIVO_DIR, '_pendentes'))
+
+def _dir_particao(ano, mes, cnpj_emitente):
+    return os.path.join(ARQUIVO_DIR, f"ano={ano}", f"mes={mes}", f"cnpj_emitente={cnpj_emitente or SEM_VALOR}")
+
+def _partes(d):
+    return sorted(os.path.join(d, a) for a in os.listdir(d) if a.endswith('.parquet')) if os.path.isdir(d) else []
+
+def _tabela_arquivo(linhas, schema=SCHEMA_ARQUIVO):
+    # linhas: tuplas na ordem de COLUNAS_NFE
+    cols = list(zip(*linhas))
+    return pa.Table.from_arrays([pa.array(cols[IDX[c]], t) for c, t in zip(schema.names, schema.types)], schema=schema)
+
+@contextmanager
+def _nova_parte(d, versao):
+    # Escreve com nome começando por '.' (leitores do dataset ignoram) e renomeia quando o arquivo está completo
+    os.makedirs(d, exist_ok=True)
+    nome = f"parte-{versao:010d}-{uuid.uuid4().hex[:8]}.parquet"
+    with pq.ParquetWriter(os.path.join(d, '.' + nome), SCHEMA_ARQUIVO) as w: yield w
+    os.replace(os.path.join(d, '.' + nome), os.path.join(d, nome))
+
+def _remover_notas(d, versao, chaves):
+    # Reescreve só as partes da partição que têm alguma das notas (a ordem se mantém no filtro)
+    chaves = pa.array(sorted(chaves), pa.string())
+    for a in _partes(d):
+        if not pc.any(pc.is_in(pq.read_table(a, columns=['chave_acesso'], partitioning=None)['chave_acesso'], chaves)).as_py():
+            continue
+        t = pq.read_table(a, schema=SCHEMA_ARQUIVO, partitioning=None)
+        t = t.filter(pc.invert(pc.is_in(t['chave_acesso'], chaves)))
+        if t.num_rows:
+            with _nova_parte(d, versao) as w: w.write_table(t)
+        os.remove(a)
+
+def _compactar(d, versao):
+    pequenas = [a for a in _partes(d) if os.path.getsize(a) < ARQUIVO_PARTE_MB * 1024 * 1024]
+    if len(pequenas) < 2: return
+    t = pa.concat_tables([pq.read_table(a, schema=SCHEMA_ARQUIVO, partitioning=None) for a in pequenas])
+    with _nova_parte(d, versao) as w: w.write_table(_ordenar(t))
+    for a in pequenas: os.remove(a)
+
+class ImportacaoArquivo:
+    # Lado do dataset de uma importação. registrar() roda com a trava, logo depois de cada commit;
+    # finalizar() no fim da importação (também quando ela falha: o que já foi gravado no banco vai junto).
+    def __init__(self):
+        self.ativa = None  # None: antes do primeiro commit; False: dataset fora de sincronia, nada a fazer
+        self.pendente = os.path.join(ARQUIVO_DIR, '_pendentes', uuid.uuid4().hex)
+        self._limpar()
+
+    def _limpar(self):
+        self.tabelas, self.linhas = [], 0
+        self.hashes = {}  # chave_acesso -> hash do XML de cada nota no buffer
+
+    def _desistir(self):
+        self.ativa = False
+        self._limpar()
+        if os.path.exists(self.pendente): os.remove(self.pendente)
+
+    def registrar(self, sess, docs, antigos):
+        # docs: {chave_acesso: (hash, Nota)} recém-gravados; antigos: resumos (chave, ano, mes, cnpj_emitente) da versão
+        # anterior das atualizadas
+        if self.ativa is False: return
+        try:
+            versao = versao_dados(sess)
+            if versao_arquivo() != versao - 1: return self._desistir()
+            if self.ativa and not os.path.exists(self.pendente): self._limpar()  # arquivar.py rodou: já cobriu o buffer
+            self.ativa = True
+            open(self.pendente, 'w').close()
+            _gravar_versao(versao)
+            atualizadas = {r['chave_acesso'] for r in antigos}
+            if atualizadas & self.hashes.keys():
+                # Nota atualizada de novo na mesma importação: a versão do buffer também sai
+                self._descartar(atualizadas)
+            # A versão anterior sai do disco agora, com a trava: deixada para o descarregamento, apagaria a versão
+            # que outra importação gravasse depois na mesma partição
+            remover = {}
+            for r in antigos:
+                remover.setdefault(_dir_particao(r['ano'], r['mes'], r['cnpj_emitente']), set()).add(r['chave_acesso'])
+            for d, chaves in remover.items(): _remover_notas(d, versao, chaves)
+            notas = [nota for _, nota in docs.values()]
+            self.tabelas.append(_tabela_arquivo(iter_linhas(notas), SCHEMA_DATASET))
+            self.hashes.update((chave, h) for chave, (h, _) in docs.items())
+            self.linhas += sum(len(nota.itens) for nota in notas)
+            if self.linhas >= ARQUIVO_LOTE: self._descarregar(versao)
+        except Exception:
+            log.exception(json.dumps({'evento': 'erro_arquivo', 'job': job_atual.get()}))
+            _gravar_versao(None)
+            self._desistir()
+
+    def _descartar(self, chaves):
+        self.tabelas = [t.filter(pc.invert(pc.is_in(t['chave_acesso'], pa.array(sorted(chaves), pa.string()))))
+                        for t in self.tabelas]
+        for c in chaves: self.hashes.pop(c, None)
+
+    def _descarregar(self, versao):
+        # Notas do buffer que outra importação atualizou depois do nosso commit: a versão dela é a que vale
+        # (já tirou a nossa do disco ou vai gravar a dela); a nossa não entra
+        sess = SessionLocal()
+        try:
+            chaves, atuais = list(self.hashes), {}
+            for i in range(0, len(chaves), 500):
+                atuais.update(sess.execute(select(Documento.chave_acesso, Documento.hash)
+                                           .where(Documento.chave_acesso.in_(chaves[i:i + 500]))).all())
+        finally: sess.close()
+        velhas = {c for c, h in self.hashes.items() if atuais.get(c) != h}
+        if velhas: self._descartar(velhas)
+        tocadas = set()
+        if self.hashes:
+            # Um row group por parte (não um por lote do banco), já na ordem do relatório
+            t = _ordenar(pa.concat_tables(self.tabelas).combine_chunks())
+            t = t.set_column(t.schema.get_field_index('cnpj_emitente'), 'cnpj_emitente',
+                             pc.if_else(pc.equal(t['cnpj_emitente'], ''), pa.scalar(None, pa.string()), t['cnpj_emitente']))
+            ds.write_dataset(t, ARQUIVO_DIR, format='parquet', partitioning=PARTICIONAMENTO,
+                             basename_template=f"parte-{versao:010d}-{uuid.uuid4().hex[:8]}-{{i}}.parquet",
+                             existing_data_behavior='overwrite_or_ignore', max_partitions=1 << 20, preserve_order=True,
+                             file_visitor=lambda f: tocadas.add(os.path.dirname(f.path)))
+        for d in tocadas: _compactar(d, versao)
+        self._limpar()
+
+    def finalizar(self):
+        if not self.ativa: return
+        with trava_arquivo():
+            try:
+                if os.path.exists(self.pendente): self._descarregar(versao_arquivo() or 0)
+            except Exception:
+                log.exception(json.dumps({'evento': 'erro_arquivo', 'job': job_atual.get()}))
+                _gravar_versao(None)
+            finally: self._desistir()
+
+def reconstruir_arquivo():
+    # Dataset inteiro a partir do banco: uma parte por partição, escrita em blocos
+    with trava_arquivo():
+        sess = SessionLocal()
+        try:
+            versao = versao_dados(sess)
+            _gravar_versao(None)
+            for a in os.listdir(ARQUIVO_DIR):
+                if a.startswith('ano='): shutil.rmtree(os.path.join(ARQUIVO_DIR, a))
+            q = select(*[getattr(NFe, c) for c in COLUNAS_NFE]) \
+                .order_by(NFe.cnpj_emitente, NFe.ano, NFe.mes, *ORDEM_ITENS)
+            n, atual, buf, w = 0, None, [], None
+            with ExitStack() as pilha:
+                for r in sess.execute(q.execution_options(stream_results=True, yield_per=EXPORT_CHUNK)):
+                    p = (r.ano, r.mes, r.cnpj_emitente)
+                    if buf and (p != atual or len(buf) >= EXPORT_CHUNK):
+                        w.write_table(_tabela_arquivo(buf))
+                        n, buf = n + len(buf), []
+                    if p != atual:
+                        pilha.close()
+                        w, atual = pilha.enter_context(_nova_parte(_dir_particao(*p), versao)), p
+                    buf.append(r)
+                if buf:
+                    w.write_table(_tabela_arquivo(buf))
+                    n += len(buf)
+            # Importações em andamento: o que elas tinham em memória já veio do banco
+            for a in os.listdir(os.path.join(ARQUIVO_DIR, '_pendentes')): os.remove(os.path.join(ARQUIVO_DIR, '_pendentes', a))
+            _gravar_versao(versao)
+            return n
+        finally:
+            sess.close()
+
+def filtro_arquivo(f):
+    # Mesmas condições de `condicoes`, como expressão do pyarrow (ano/mes/cnpj_emitente podam diretórios)
+    campo = ds.field
+    c = []
+    if 'anos' in f: c.append(campo('ano').isin(f['anos']))
+    if 'mes_de' in f:
+        a, m = f['mes_de'].split('-')
+        c.append((campo('ano') > a) | ((campo('ano') == a) & (campo('mes') >= m)))
+    if 'mes_ate' in f:
+        a, m = f['mes_ate'].split('-')
+        c.append((campo('ano') < a) | ((campo('ano') == a) & (campo('mes') <= m)))
+    if 'cnpj_emitente' in f: c.append(campo('cnpj_emitente').isin(f['cnpj_emitente']))
+    if 'cnpj_destinatario' in f: c.append(campo('cnpj_destinatario').isin(f['cnpj_destinatario']))
+    for k, tamanho in TAMANHO_CODIGO.items():
+        if k not in f: continue
+        e = None
+        for v in f[k]:
+            x = campo(k) == v if len(v) >= tamanho else (campo(k) >= v) & (campo(k) < v[:-1] + chr(ord(v[-1]) + 1))
+            e = x if e is None else e | x
+        c.append(e)
+    if 'uf' in f: c.append(campo('uf_emitente').isin(f['uf']))
+    e = None
+    for x in c: e = x if e is None else e & x
+    return e
+
+def _no_periodo(ano, mes, f):
+    if 'anos' in f and ano not in f['anos']: return False
+    return f.get('mes_de', '') <= f"{ano}-{mes}" <= f.get('mes_ate', '9999')
+
+def _instantaneo(filtros):
+    # Hardlinks das partes que o relatório vai ler (meses e emitentes do filtro) em _leituras/<id>, feitos com a
+    # trava: parte que uma importação reescrever ou apagar durante a leitura continua inteira para este relatório
+    base = os.path.join(ARQUIVO_DIR, '_leituras', uuid.uuid4().hex)
+    os.makedirs(base)
+    for a in os.listdir(ARQUIVO_DIR):
+        if not a.startswith('ano='): continue
+        for m in os.listdir(os.path.join(ARQUIVO_DIR, a)):
+            if not _no_periodo(a[4:], m[4:], filtros): continue
+            for e in os.listdir(os.path.join(ARQUIVO_DIR, a, m)):
+                if 'cnpj_emitente' in filtros and e[14:] not in filtros['cnpj_emitente']: continue
+                for parte in _partes(os.path.join(ARQUIVO_DIR, a, m, e)):
+                    os.makedirs(os.path.join(base, a, m, e), exist_ok=True)
+                    os.link(parte, os.path.join(base, a, m, e, os.path.basename(parte)))
+    return base
+
+def iter_arquivo(base, filtros):
+    # Mesmo contrato do iter_relatorio (lotes na ordem do relatório). As partes já estão nessa ordem (_ordenar):
+    # cada mês sai de um merge das partes lidas em lotes (só as colunas do relatório, filtro aplicado na
+    # leitura), e a memória fica em um lote por parte do mês, não no tamanho do relatório.
+    dataset = ds.dataset(base, format='parquet', partitioning=PARTICIONAMENTO, schema=SCHEMA_DATASET)
+    colunas = [c for c, _ in CAMPOS_RELATORIO] + ['chave_item']
+    filtro = filtro_arquivo(filtros)
+    i_data, i_chave = colunas.index('data_nfe'), colunas.index('chave_acesso')
+
+    def ordem(l): return l[i_data], l[i_chave], _numero_item(l[-1])
+
+    def linhas(parte, e):
+        for b in parte.to_batches(schema=SCHEMA_DATASET, columns=colunas, filter=e, batch_size=EXPORT_CHUNK):
+            cols = [b.column(c) for c in colunas]
+            cols[colunas.index('cnpj_emitente')] = pc.fill_null(b.column('cnpj_emitente'), '')
+            yield from zip(*[c.to_pylist() for c in cols])
+
+    meses = sorted((a[4:], m[4:]) for a in os.listdir(base) for m in os.listdir(os.path.join(base, a)))
+    for ano, mes in meses:
+        e = (ds.field('ano') == ano) & (ds.field('mes') == mes)
+        if filtro is not None: e = e & filtro
+        it = heapq.merge(*[linhas(parte, e) for parte in dataset.get_fragments(filter=e)], key=ordem)
+        while lote := list(islice(it, EXPORT_CHUNK)): yield lote
+
+@app.on_event("startup")
+def preparar_arquivo():
+    if not ARQUIVO_DIR: return
+    with trava_inicializacao(), trava_arquivo():
+        # Leituras de relatório que não terminaram (processo derrubado): só hardlinks, mas ocupam o disco
+        # das partes já substituídas. Com mais de um worker, as de outro processo podem estar em uso.
+        for a in os.listdir(os.path.join(ARQUIVO_DIR, '_leituras')):
+            d = os.path.join(ARQUIVO_DIR, '_leituras', a)
+            if time.time() - os.path.getmtime(d) > 86400: shutil.rmtree(d, ignore_errors=True)
+        sess = SessionLocal()
+        try:
+            if arquivo_em_dia(sess): return
+            versao = versao_dados(sess)
+            if versao_arquivo() is None and sess.scalar(select(NFe.chave_item).limit(1)) is None:
+                # Banco vazio: o dataset começa junto com ele
+                for a in os.listdir(ARQUIVO_DIR):
+                    if a.startswith('ano='): shutil.rmtree(os.path.join(ARQUIVO_DIR, a))
+                _gravar_versao(versao)
+            else:
+                # Pendência sem importação rodando é de uma importação derrubada no meio
+                log.warning(json.dumps({'evento': 'arquivo_desatualizado', 'versao_banco': versao, 'versao_arquivo': versao_arquivo(),
+                                        'pendentes': len(os.listdir(os.path.join(ARQUIVO_DIR, '_pendentes'))),
+                                        'msg': 'relatórios leem do banco até rodar python arquivar.py'}, ensure_ascii=False))
+        finally: sess.close()
+
+def estimar_itens(filtros):
+    # Teto de itens do relatório: o resumo mensal não tem CFOP/NCM/UF, esses filtros só podem diminuir a conta
+    sess = SessionLocal()
+    try:
+        f = {k: v for k, v in filtros.items() if k in FILTROS_RESUMO}
+        return sess.scalar(select(func.coalesce(func.sum(ResumoMensal.qtd_itens), 0)).where(*condicoes(ResumoMensal, f)))
+    finally: sess.close()
+
+def lotes_relatorio(filtros, stats):
+    # Dataset em dia com o banco: o relatório nem passa pelo banco. A trava compartilhada só cobre a
+    # conferência da versão e os hardlinks; a leitura (e a escrita do relatório) corre sem ela.
+    base = None
+    if ARQUIVO_DIR and estimar_itens(filtros) >= ARQUIVO_MIN_ITENS:
+        with trava_arquivo(compartilhada=True):
+            sess = SessionLocal()
+            try: em_dia = arquivo_em_dia(sess)
+            finally: sess.close()
+            if em_dia: base = _instantaneo(filtros)
+    if base:
+        stats['fonte'] = 'arquivo'
+        try: yield from iter_arquivo(base, filtros)
+        finally: shutil.rmtree(base, ignore_errors=True)
+        return
+    stats['fonte'] = 'banco'
+    yield from iter_relatorio(filtros)
+
+# --- CACHE DE RELATÓRIOS ---
+# Mesmo pedido (filtros, formato) sobre os mesmos dados devolve o arquivo já gerado. O conteúdo não depende
+# do CNPJ informado (ele só muda o resumo da tela, que vem das tabelas de resumo), então ele fica fora da chave.
+# REPORTS_DIR tem limite de tamanho: os arquivos usados há mais tempo são apagados primeiro.
+REPORTS_MAX_MB = int(os.getenv("REPORTS_MAX_MB", "2048"))
+
+def chave_cache(sess, filtros, formato):
+    versao = versao_dados(sess)
+    return hashlib.sha256(json.dumps([filtros, formato, versao], sort_keys=True).encode()).hexdigest()
+
+def buscar_cache(sess, chave):
+    c = sess.get(CacheRelatorio, chave)
+    if c is None: return None
+    if not os.path.exists(os.path.join(REPORTS_DIR, c.filename)):
+        sess.delete(c)
+        sess.commit()
+        return None
+    c.ultimo_acesso = datetime.now()
+    sess.commit()
+    return c.filename
+
+def limpar_relatorios(sess, manter):
+    acessos = dict(sess.execute(select(CacheRelatorio.filename, CacheRelatorio.ultimo_acesso)).all())
+    arquivos = []
+    for f in os.listdir(REPORTS_DIR):
+        if f.startswith('.'): continue  # relatório ainda sendo escrito
+        st = os.stat(os.path.join(REPORTS_DIR, f))
+        arquivos.append((acessos.get(f) or datetime.fromtimestamp(st.st_mtime), st.st_size, f))
+    total, limite, removidos = sum(a[1] for a in arquivos), REPORTS_MAX_MB * 1024 * 1024, []
+    for _, tamanho, f in sorted(arquivos):
+        if total <= limite: break
+        if f == manter: continue
+        os.remove(os.path.join(REPORTS_DIR, f))
+        total -= tamanho
+        removidos.append(f)
+    if removidos:
+        sess.execute(delete(CacheRelatorio).where(CacheRelatorio.filename.in_(removidos)))
+        sess.commit()
+
+def exportar(filtros, formato, progresso=None, stats=None):
+    # Sufixo aleatório: dois jobs de relatório no mesmo segundo não gravam no mesmo arquivo.
+    # Escreve num nome temporário ('.' na frente, fora da limpeza) e só publica o arquivo completo.
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"Relatorio_Fiscal_{timestamp}_{uuid.uuid4().hex[:8]}.{formato}"
+    filepath = os.path.join(REPORTS_DIR, f".{filename}.tmp")
+
+    stats = {} if stats is None else stats
+    stats['linhas'] = 0
+    tempos = stats.setdefault('tempos', {})
+    try:
+        # consulta: tempo esperando o banco ou o dataset (ordenação inclusa); escrita: o resto, montando e gravando o arquivo
+        ini, consulta = time.perf_counter(), tempos.get('consulta', 0.0)
+        lotes = cronometrar(lotes_relatorio(filtros, stats), tempos, 'consulta')
+        ESCRITORES[formato](filepath, com_progresso(lotes, stats, progresso))
+        tempos['escrita'] = time.perf_counter() - ini - (tempos['consulta'] - consulta)
+    except Exception:
+        if os.path.exists(filepath): os.remove(filepath)
+        raise
+    if not stats['linhas']:
+        os.remove(filepath)
+        return None
+    os.replace(filepath, os.path.join(REPORTS_DIR, filename))
+    return filename
+
+def gerar_relatorio(filtros, meu_cnpj, formato='xlsx', progresso=None):
+    # filtros já normalizados (normalizar_filtros): a mesma seleção gera sempre a mesma chave de cache
+    stats = {'linhas': 0, 'tempos': {}}
+    tempos = stats['tempos']
+    ini, status, cache = time.perf_counter(), 'erro', 'gerado'
+    try:
+        with cronometro(tempos, 'cache'):
+            sess = SessionLocal()
+            try:
+                chave = chave_cache(sess, filtros, formato)
+                filename = buscar_cache(sess, chave)
+            finally: sess.close()
+
+        if filename is None:
+            filename = exportar(filtros, formato, progresso, stats)
+            if filename is None:
+                status = 'sem_dados'
+                return {"ok": False, "msg": "Sem dados."}
+            with cronometro(tempos, 'cache'):
+                sess = SessionLocal()
+                try:
+                    upsert(sess, CacheRelatorio, [{'chave': chave, 'filename': filename, 'ultimo_acesso': datetime.now()}])
+                    sess.commit()
+                    limpar_relatorios(sess, manter=filename)
+                finally: sess.close()
+        else: cache = 'cache'
+
+        # Prova Real (das tabelas de resumo, sem reler os itens)
+        with cronometro(tempos, 'resumo'):
+            sess = SessionLocal()
+            try: resumo = resumo_totais(sess, filtros, meu_cnpj)
+            finally: sess.close()
+        status = 'ok'
+        return {"ok": True, "filename": filename, **resumo, "url": f"/download/{filename}"}
+    finally:
+        segundos = time.perf_counter() - ini
+        contar('nfe_relatorio_linhas_total', stats['linhas'], formato=formato)
+        contar('nfe_relatorio_cache_total', resultado=cache)
+        observar('nfe_relatorio_segundos', segundos, formato=formato, status=status)
+        registrar('relatorio', 'nfe_relatorio', segundos, tempos, status=status, formato=formato, filtros=filtros,
+                  cache=cache, fonte=stats.get('fonte'), linhas=stats['linhas'])
+
+# --- JOBS EM SEGUNDO PLANO ---
+# Importações e relatórios podem rodar como job: a rota devolve o id na hora e o front consulta o
+# progresso em /jobs/{id}. O estado fica na tabela jobs; os jobs rodam num pool de threads limitado,
+# com limite de concorrência por tipo.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_LIMITES = {'upload': int(os.getenv("JOB_LIMITE_UPLOAD", "1")), 'gerar': int(os.getenv("JOB_LIMITE_GERAR", "2")),
+               # Upload em partes: passa a maior parte do tempo esperando bytes, e só ocupa uma vaga de
+               # 'upload' enquanto importa (ocupar_vaga/liberar_vaga). Tem threads próprias no pool.
+               'sessao': int(os.getenv("JOB_LIMITE_SESSAO", "8"))}
+JOB_HEARTBEAT = 15  # segundos entre sinais de vida dos jobs deste processo
+JOB_TIMEOUT = 90    # sem sinal de vida por mais que isso: o processo que rodava o job morreu
+
+_jobs_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS + JOB_LIMITES['sessao'])
+_jobs_lock = threading.Lock()
+_jobs_vaga = threading.Condition(_jobs_lock)
+_jobs_fila = {tipo: deque() for tipo in JOB_LIMITES}
+_jobs_rodando = {tipo: 0 for tipo in JOB_LIMITES}
+_jobs_ativos = set()
+_heartbeat = None
+
+def _atualizar_job(job_id, **campos):
+    sess = SessionLocal()
+    try:
+        sess.execute(update(Job).where(Job.id == job_id).values(atualizado_em=datetime.now(), **campos))
+        sess.commit()
+    finally:
+        sess.close()
+
+class _ProgressoJob:
+    # No máximo uma escrita por segundo no banco; o último estado vai junto com o status final (final()).
+    # Só os contadores são publicados (XMLs lidos, itens/linhas gravados...), não os tempos internos.
+    def __init__(self, job_id):
+        self.job_id, self.ultimo, self.dados = job_id, 0.0, None
+
+    def __call__(self, dados):
+        self.dados = dados
+        agora = time.monotonic()
+        if agora - self.ultimo < 1: return
+        self.ultimo = agora
+        _atualizar_job(self.job_id, progresso=self.texto())
+
+    def texto(self):
+        return json.dumps({k: v for k, v in self.dados.items() if isinstance(v, (int, float))})
+
+    def final(self):
+        return {'progresso': self.texto()} if self.dados is not None else {}
+
+def _sinal_de_vida():
+    while True:
+        time.sleep(JOB_HEARTBEAT)
+        with _jobs_lock: ids = list(_jobs_ativos)
+        if not ids: continue
+        sess = SessionLocal()
+        try:
+            sess.execute(update(Job).where(Job.id.in_(ids)).values(atualizado_em=datetime.now()))
+            sess.commit()
+        except Exception: sess.rollback()
+        finally: sess.close()
+
+def _despachar():
+    with _jobs_lock:
+        for tipo, fila in _jobs_fila.items():
+            while fila and _jobs_rodando[tipo] < JOB_LIMITES[tipo]:
+                _jobs_rodando[tipo] += 1
+                _jobs_pool.submit(_executar_job, tipo, *fila.popleft())
+
+def _executar_job(tipo, job_id, fn, args, enfileirado):
+    token = job_atual.set(job_id)
+    ini, status = time.monotonic(), 'erro'
+    progresso = _ProgressoJob(job_id)
+    try:
+        _atualizar_job(job_id, status='executando')
+        res = fn(*args, progresso=progresso)
+        _atualizar_job(job_id, status='concluido', resultado=json.dumps(res), **progresso.final())
+        status = 'concluido'
+    except Exception as e:
+        log.exception(json.dumps({'evento': 'erro_job', 'job': job_id, 'tipo': tipo}))
+        _atualizar_job(job_id, status='erro', erro=str(e), **progresso.final())
+    finally:
+        contar('nfe_jobs_finalizados_total', tipo=tipo, status=status)
+        log.info(json.dumps({'evento': 'job', 'job': job_id, 'tipo': tipo, 'status': status,
+                             'espera': round(ini - enfileirado, 3), 'segundos': round(time.monotonic() - ini, 3)}))
+        job_atual.reset(token)
+        with _jobs_vaga:
+            _jobs_rodando[tipo] -= 1
+            _jobs_ativos.discard(job_id)
+            _jobs_vaga.notify_all()
+        _despachar()
+
+def ocupar_vaga(tipo):
+    # Vaga pega no meio de outro job (upload em partes quando chegam bytes): espera uma vaga livre
+    with _jobs_vaga:
+        while _jobs_rodando[tipo] >= JOB_LIMITES[tipo]: _jobs_vaga.wait()
+        _jobs_rodando[tipo] += 1
+
+def liberar_vaga(tipo):
+    with _jobs_vaga:
+        _jobs_rodando[tipo] -= 1
+        _jobs_vaga.notify_all()
+    _despachar()
+
+def submeter_job(tipo, fn, *args, job_id=None):
+    global _heartbeat
+    job_id = job_id or uuid.uuid4().hex
+    agora = datetime.now()
+    sess = SessionLocal()
+    try:
+        sess.add(Job(id=job_id, tipo=tipo, status='pendente', progresso='{}', criado_em=agora, atualizado_em=agora))
+        sess.commit()
+    finally:
+        sess.close()
+    with _jobs_lock:
+        _jobs_ativos.add(job_id)
+        _jobs_fila[tipo].append((job_id, fn, args, time.monotonic()))
+        if _heartbeat is None:
+            _heartbeat = threading.Thread(target=_sinal_de_vida, daemon=True)
+            _heartbeat.start()
+    _despachar()
+    return job_id
+
+def job_parado(job):
+    # Job que não vai mais andar: com erro ou sem sinal de vida há JOB_TIMEOUT (processo reiniciado)
+    if job.status == 'erro': return True
+    return job.status in ('pendente', 'executando') and (datetime.now() - job.atualizado_em).total_seconds() > JOB_TIMEOUT
+
+def limpar_spool():
+    # ZIPs de /jobs/upload ({job_id}_{i}.zip) cujo job não vai mais andar (processo reiniciado no meio):
+    # ninguém mais vai importá-los. Arquivo recente fica (o job ainda pode estar sendo criado).
+    orfaos = {}
+    for a in os.listdir(UPLOAD_DIR):
+        m = re.fullmatch(r'([0-9a-f]{32})_\d+\.zip', a)
+        caminho = os.path.join(UPLOAD_DIR, a)
+        if m and time.time() - os.path.getmtime(caminho) > JOB_TIMEOUT: orfaos.setdefault(m.group(1), []).append(caminho)
+    if not orfaos: return
+    sess = SessionLocal()
+    try: jobs = {j.id: j for j in sess.scalars(select(Job).where(Job.id.in_(list(orfaos))))}
+    finally: sess.close()
+    for job_id, caminhos in orfaos.items():
+        job = jobs.get(job_id)
+        if job is None or job.status not in ('pendente', 'executando') or job_parado(job):
+            for c in caminhos:
+                if os.path.exists(c): os.remove(c)
+
+def _job_upload(caminhos, progresso=None):
+    try:
+        fontes = [open(c, 'rb') for c in caminhos]
+        try: stats = importar_zips(fontes, progresso)
+        finally:
+            for f in fontes: f.close()
+        return resposta_importacao(stats)
+    finally:
+        for c in caminhos:
+            if os.path.exists(c): os.remove(c)
+
+# --- UPLOAD EM PARTES ---
+# ZIPs grandes chegam em partes (PUT com Content-Range) numa sessão que pode ser retomada: o cliente consulta
+# quanto já chegou e continua dali. O job de importação começa junto com a sessão e lê os membros do ZIP
+# conforme os bytes chegam (iter_zip_stream), então transferência e processamento andam juntos. Cada parte
+# pode trazer o próprio sha256 (X-Chunk-Sha256); o sha256 do arquivo inteiro, se informado (na criação ou ao concluir),
+# é conferido ao concluir. A página o calcula enquanto envia e manda ao concluir (em JS quando não há crypto.subtle,
+# HTTP sem TLS como no Dockerfile).
+# O job (tipo 'sessao') só ocupa uma vaga de 'upload' enquanto tem bytes para importar: esperando a transferência,
+# a vaga fica para as outras importações. Uma sessão abandonada encerra o job após UPLOAD_ESPERA.
+UPLOAD_PARTE_MAX_MB = int(os.getenv("UPLOAD_PARTE_MAX_MB", "64"))
+UPLOAD_ESPERA = int(os.getenv("UPLOAD_ESPERA", "600"))            # segundos sem bytes novos até o job desistir
+UPLOAD_EXPIRA_HORAS = int(os.getenv("UPLOAD_EXPIRA_HORAS", "24"))  # sessões paradas há mais tempo são apagadas
+UPLOAD_POLL = 0.5
+
+_uploads_travas = {}  # sessão -> Lock da escrita das partes entre as threads deste processo
+_uploads_hash = {}    # sessão -> (posição, sha256 parcial), para não reler o arquivo ao concluir
+
+class UploadInterrompido(Exception): pass
+
+def caminho_upload(sessao_id):
+    return os.path.join(UPLOAD_DIR, f"sessao_{sessao_id}.zip")
+
+def estado_sessao(s):
+    return {"ok": True, "id": s.id, "nome": s.nome, "tamanho": s.tamanho, "recebido": s.recebido,
+            "status": s.status, "job_id": s.job_id, "erro": s.erro}
+
+def _atualizar_sessao(sessao_id, **campos):
+    sess = SessionLocal()
+    try:
+        sess.execute(update(UploadSessao).where(UploadSessao.id == sessao_id).values(atualizado_em=datetime.now(), **campos))
+        sess.commit()
+    finally:
+        sess.close()
+
+class ArquivoCrescente:
+    # Lê o arquivo de uma sessão enquanto ele ainda chega: sem bytes novos, solta a vaga de 'upload',
+    # espera e consulta a sessão; com bytes de novo, espera uma vaga para continuar a importação
+    def __init__(self, sessao_id, tamanho):
+        self.sessao_id, self.tamanho, self.pos = sessao_id, tamanho, 0
+        self.f = open(caminho_upload(sessao_id), 'rb')
+        self.vaga = False
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+        if self.vaga: liberar_vaga('upload')
+
+    def read(self, n=-1):
+        n = self.tamanho - self.pos if n < 0 else min(n, self.tamanho - self.pos)
+        partes, ultimo = [], time.monotonic()
+        while n > 0:
+            b = self.f.read(n)
+            if b:
+                if not self.vaga:
+                    ocupar_vaga('upload')
+                    self.vaga = True
+                partes.append(b)
+                n -= len(b)
+                self.pos += len(b)
+                ultimo = time.monotonic()
+                continue
+            if self.vaga:
+                liberar_vaga('upload')
+                self.vaga = False
+            time.sleep(UPLOAD_POLL)
+            sess = SessionLocal()
+            try: s = sess.get(UploadSessao, self.sessao_id)
+            finally: sess.close()
+            if s is None or s.status in ('erro', 'cancelado'): raise UploadInterrompido("Upload interrompido.")
+            if time.monotonic() - ultimo > UPLOAD_ESPERA:
+                raise UploadInterrompido("Upload parado: retome o envio para continuar a importação.")
+        return b''.join(partes)
+
+def _job_sessao(sessao_id, progresso=None):
+    sess = SessionLocal()
+    try: tamanho = sess.get(UploadSessao, sessao_id).tamanho
+    finally: sess.close()
+    try:
+        with ArquivoCrescente(sessao_id, tamanho) as f:
+            stats = importar_xmls(iter_zip_stream(f), progresso)
+    except zipfile.BadZipFile as e:
+        _atualizar_sessao(sessao_id, status='erro', erro=f"ZIP inválido: {e}")
+        raise
+    _atualizar_sessao(sessao_id, importado=1)
+    sess = SessionLocal()
+    try: limpar_sessao(sess.get(UploadSessao, sessao_id))
+    finally: sess.close()
+    return resposta_importacao(stats)
+
+def garantir_job(sess, s):
+    # Sem job vivo (servidor reiniciado, espera esgotada): começa outro do início do arquivo; o que já
+    # foi importado é reconhecido pelo hash e pulado. O update condicional evita dois jobs para a mesma sessão.
+    if s.status not in ('recebendo', 'recebido') or s.importado: return
+    if s.job_id:
+        job = sess.get(Job, s.job_id)
+        if job is not None and not job_parado(job): return
+    novo = uuid.uuid4().hex
+    anterior = UploadSessao.job_id == s.job_id if s.job_id else UploadSessao.job_id.is_(None)
+    r = sess.execute(update(UploadSessao).where(UploadSessao.id == s.id, anterior).values(job_id=novo))
+    sess.commit()
+    if r.rowcount == 1: submeter_job('sessao', _job_sessao, s.id, job_id=novo)
+    sess.refresh(s)
+
+def limpar_sessao(s):
+    # O arquivo só é necessário até ser importado e conferido
+    if s.status in ('erro', 'cancelado') or (s.status == 'recebido' and s.importado):
+        if os.path.exists(caminho_upload(s.id)): os.remove(caminho_upload(s.id))
+        _uploads_hash.pop(s.id, None)
+
+def expirar_sessoes(sess):
+    limite = datetime.now() - timedelta(hours=UPLOAD_EXPIRA_HORAS)
+    velhas = sess.scalars(select(UploadSessao.id).where(UploadSessao.atualizado_em < limite)).all()
+    for sessao_id in velhas:
+        if os.path.exists(caminho_upload(sessao_id)): os.remove(caminho_upload(sessao_id))
+        _uploads_travas.pop(sessao_id, None)
+        _uploads_hash.pop(sessao_id, None)
+    if velhas:
+        sess.execute(delete(UploadSessao).where(UploadSessao.id.in_(velhas)))
+        sess.commit()
+
+def criar_sessao(nome, tamanho, sha256=''):
+    sess = SessionLocal()
+    try:
+        expirar_sessoes(sess)
+        sessao_id, agora = uuid.uuid4().hex, datetime.now()
+        open(caminho_upload(sessao_id), 'wb').close()
+        s = UploadSessao(id=sessao_id, nome=nome, tamanho=tamanho, recebido=0, sha256=sha256.strip().lower(),
+                         status='recebendo', importado=0, criado_em=agora, atualizado_em=agora)
+        sess.add(s)
+        sess.commit()
+        garantir_job(sess, s)
+        return estado_sessao(s)
+    finally:
+        sess.close()
+
+@contextmanager
+def _trava(sessao_id):
+    # Lock entre threads deste processo + flock no arquivo da sessão, que vale entre os workers (WEB_CONCURRENCY)
+    with _uploads_travas.setdefault(sessao_id, threading.Lock()):
+        try: f = open(caminho_upload(sessao_id), 'rb')
+        except FileNotFoundError: f = None
+        try:
+            if f is not None and fcntl is not None: fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+        finally:
+            if f is not None: f.close()
+
+def gravar_parte(sessao_id, inicio, total, corpo, sha_parte=None):
+    # Devolve (status http, resposta). A parte só é aceita na posição esperada; fora dela o cliente
+    # recebe 409 com a posição certa e retoma dali.
+    if sha_parte and hashlib.sha256(corpo).hexdigest() != sha_parte.strip().lower():
+        return 400, {"ok": False, "msg": "Checksum da parte não confere."}
+    with _trava(sessao_id):
+        sess = SessionLocal()
+        try:
+            s = sess.get(UploadSessao, sessao_id)
+            if s is None: return 404, {"ok": False, "msg": "Upload não encontrado."}
+            if s.status != 'recebendo': return 409, {"ok": False, "msg": s.erro or f"Upload {s.status}.", "status": s.status}
+            if total != s.tamanho or inicio + len(corpo) > s.tamanho:
+                return 400, {"ok": False, "msg": "Content-Range não confere com o tamanho do arquivo."}
+            if inicio != s.recebido:
+                return 409, {"ok": False, "msg": "Parte fora de ordem.", "recebido": s.recebido}
+            # Bytes além de `recebido` (escrita interrompida) são descartados antes de gravar
+            with open(caminho_upload(sessao_id), 'r+b') as f:
+                f.seek(inicio)
+                f.truncate()
+                f.write(corpo)
+                f.flush()
+                os.fsync(f.fileno())
+            fim = inicio + len(corpo)
+            sess.execute(update(UploadSessao).where(UploadSessao.id == sessao_id)
+                         .values(recebido=fim, atualizado_em=datetime.now()))
+            sess.commit()
+            pos, h = (0, hashlib.sha256()) if inicio == 0 else _uploads_hash.get(sessao_id, (None, None))
+            if pos == inicio:
+                h.update(corpo)
+                _uploads_hash[sessao_id] = (fim, h)
+            else: _uploads_hash.pop(sessao_id, None)
+            garantir_job(sess, s)
+            return 200, {"ok": True, "recebido": fim}
+        finally:
+            sess.close()
+
+def _sha256_arquivo(caminho):
+    h = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for b in iter(lambda: f.read(PEDACO_ZIP), b''): h.update(b)
+    return h.hexdigest()
+
+def concluir_sessao(sessao_id, sha256=''):
+    with _trava(sessao_id):
+        sess = SessionLocal()
+        try:
+            s = sess.get(UploadSessao, sessao_id)
+            if s is None: return 404, {"ok": False, "msg": "Upload não encontrado."}
+            if s.status == 'recebido': return 200, estado_sessao(s)
+            if s.status != 'recebendo': return 409, {"ok": False, "msg": s.erro or f"Upload {s.status}.", "status": s.status}
+            if s.recebido < s.tamanho:
+                return 409, {"ok": False, "msg": f"Faltam {s.tamanho - s.recebido} bytes.", "recebido": s.recebido}
+            esperado = (sha256 or s.sha256 or '').strip().lower()
+            if esperado:
+                pos, h = _uploads_hash.get(sessao_id, (None, None))
+                # Partes recebidas por outro processo (ou antes de reiniciar): relê o arquivo
+                calculado = h.hexdigest() if pos == s.tamanho else _sha256_arquivo(caminho_upload(sessao_id))
+                if calculado != esperado:
+                    s.status, s.erro, s.atualizado_em = 'erro', "Checksum do arquivo não confere: envie de novo.", datetime.now()
+                    sess.commit()
+                    limpar_sessao(s)
+                    return 400, {"ok": False, "msg": s.erro}
+            s.status, s.atualizado_em = 'recebido', datetime.now()
+            sess.commit()
+            garantir_job(sess, s)
+            limpar_sessao(s)
+            return 200, estado_sessao(s)
+        finally:
+            sess.close()
+
+def cancelar_sessao(sessao_id):
+    sess = SessionLocal()
+    try:
+        s = sess.get(UploadSessao, sessao_id)
+        if s is None: return 404, {"ok": False, "msg": "Upload não encontrado."}
+        if s.status == 'recebendo':
+            s.status, s.atualizado_em = 'cancelado', datetime.now()
+            sess.commit()
+            limpar_sessao(s)
+        return 200, estado_sessao(s)
+    finally:
+        sess.close()
+
+# --- ROTAS ---
+# Rotas com trabalho bloqueante (sessão do banco, disco, parse, escrita de relatório) são `def` ou passam
+# por run_in_threadpool: rodam no pool de threads e o event loop fica livre para as outras requisições.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
+@app.on_event("startup")
+async def ajustar_threadpool():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+@app.on_event("startup")
+def limpar_spool_inicio():
+    limpar_spool()
+
+@app.post("/upload")
+async def upload(files: List[UploadFile] = File(...)):
+    try:
+        # Roda fora do event loop: o servidor continua respondendo durante a importação
+        stats = await run_in_threadpool(importar_zips, [f.file for f in files])
+        return JSONResponse(resposta_importacao(stats))
+    except Exception as e:
+        return JSONResponse({"ok": False, "msg": str(e)})
+
+def filtros_form(anos: str = Form(""), mes_de: str = Form(""), mes_ate: str = Form(""), cnpj_emitente: str = Form(""),
+                 cnpj_destinatario: str = Form(""), cfop: str = Form(""), ncm: str = Form(""), uf: str = Form("")):
+    return dict(anos=anos, mes_de=mes_de, mes_ate=mes_ate, cnpj_emitente=cnpj_emitente,
+                cnpj_destinatario=cnpj_destinatario, cfop=cfop, ncm=ncm, uf=uf)
+
+def filtros_query(anos: str = "", mes_de: str = "", mes_ate: str = "", cnpj_emitente: str = "",
+                  cnpj_destinatario: str = "", cfop: str = "", ncm: str = "", uf: str = ""):
+    return dict(anos=anos, mes_de=mes_de, mes_ate=mes_ate, cnpj_emitente=cnpj_emitente,
+                cnpj_destinatario=cnpj_destinatario, cfop=cfop, ncm=ncm, uf=uf)
+
+@app.get("/filtros")
+def get_filtros(anos: str = "", mes_de: str = "", mes_ate: str = "", limite: int = 200):
+    # Facetas do período escolhido (anos/meses); a lista de anos é sempre a completa
+    try: f = normalizar_filtros(anos, mes_de, mes_ate)
+    except ValueError as e: return JSONResponse({"ok": False, "msg": str(e)})
+    s = SessionLocal()
+    try: return {"ok": True, **facetas(s, f, limite)}
+    finally: s.close()
+
+@app.get("/historico")
+def get_historico():
+    files = []
+    for f in os.listdir(REPORTS_DIR):
+        if f.rsplit('.', 1)[-1] in FORMATOS:
+            path = os.path.join(REPORTS_DIR, f)
+            t = os.path.getmtime(path)
+            dt = datetime.fromtimestamp(t).strftime('%d/%m/%Y %H:%M')
+            files.append({"nome": f, "data": dt})
+    files.sort(key=lambda x: x['nome'], reverse=True)
+    return {"arquivos": files}
+
+@app.get("/resumo")
+def get_resumo(meu_cnpj: str = "", filtros: dict = Depends(filtros_query)):
+    try: f = normalizar_filtros(**filtros)
+    except ValueError as e: return JSONResponse({"ok": False, "msg": str(e)})
+    s = SessionLocal()
+    try: return {"ok": True, **resumo_totais(s, f, meu_cnpj)}
+    finally: s.close()
+
+@app.post("/gerar")
+async def gerar(meu_cnpj: str = Form(""), formato: str = Form("xlsx"), filtros: dict = Depends(filtros_form)):
+    if formato not in FORMATOS: return JSONResponse({"ok": False, "msg": "Formato inválido."})
+    try: f = normalizar_filtros(**filtros)
+    except ValueError as e: return JSONResponse({"ok": False, "msg": str(e)})
+    return JSONResponse(await run_in_threadpool(gerar_relatorio, f, meu_cnpj, formato))
+
+@app.post("/jobs/upload")
+async def job_upload(files: List[UploadFile] = File(...)):
+    # O upload termina junto com a requisição: guarda os ZIPs em disco para o job (nomeados pelo id do job)
+    await run_in_threadpool(limpar_spool)
+    job_id = uuid.uuid4().hex
+    caminhos = []
+    for i, file in enumerate(files):
+        caminho = os.path.join(UPLOAD_DIR, f"{job_id}_{i}.zip")
+        with open(caminho, "wb") as b: await run_in_threadpool(shutil.copyfileobj, file.file, b)
+        caminhos.append(caminho)
+    await run_in_threadpool(submeter_job, 'upload', _job_upload, caminhos, job_id=job_id)
+    return {"ok": True, "job_id": job_id}
+
+@app.post("/jobs/gerar")
+async def job_gerar(meu_cnpj: str = Form(""), formato: str = Form("xlsx"), filtros: dict = Depends(filtros_form)):
+    if formato not in FORMATOS: return JSONResponse({"ok": False, "msg": "Formato inválido."})
+    try: f = normalizar_filtros(**filtros)
+    except ValueError as e: return JSONResponse({"ok": False, "msg": str(e)})
+    job_id = await run_in_threadpool(submeter_job, 'gerar', gerar_relatorio, f, meu_cnpj, formato)
+    return {"ok": True, "job_id": job_id}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    s = SessionLocal()
+    try:
+        job = s.get(Job, job_id)
+        if job is None: return JSONResponse({"msg": "Job não encontrado"}, 404)
+        if job.status != 'erro' and job_parado(job):
+            job.status, job.erro = 'erro', 'Job interrompido (servidor reiniciado).'
+            s.commit()
+        return {
+            "id": job.id,
+            "tipo": job.tipo,
+            "status": job.status,
+            "progresso": json.loads(job.progresso or '{}'),
+            "resultado": json.loads(job.resultado) if job.resultado else None,
+            "erro": job.erro,
+        }
+    finally: s.close()
+
+@app.post("/uploads")
+async def criar_upload(nome: str = Form(...), tamanho: int = Form(...), sha256: str = Form("")):
+    if tamanho <= 0: return JSONResponse({"ok": False, "msg": "Tamanho inválido."}, 400)
+    return await run_in_threadpool(criar_sessao, nome, tamanho, sha256)
+
+@app.get("/uploads/{sessao_id}")
+def get_upload(sessao_id: str):
+    s = SessionLocal()
+    try:
+        sessao = s.get(UploadSessao, sessao_id)
+        if sessao is None: return JSONResponse({"ok": False, "msg": "Upload não encontrado."}, 404)
+        return estado_sessao(sessao)
+    finally: s.close()
+
+@app.put("/uploads/{sessao_id}")
+async def enviar_parte(sessao_id: str, request: Request):
+    faixa = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', request.headers.get('content-range', '').strip())
+    if faixa is None: return JSONResponse({"ok": False, "msg": "Content-Range inválido."}, 400)
+    inicio, fim, total = map(int, faixa.groups())
+    if fim < inicio: return JSONResponse({"ok": False, "msg": "Content-Range inválido."}, 400)
+    if fim - inicio + 1 > UPLOAD_PARTE_MAX_MB * 1024 * 1024:
+        return JSONResponse({"ok": False, "msg": f"Parte maior que {UPLOAD_PARTE_MAX_MB} MB."}, 413)
+    corpo = await request.body()
+    if len(corpo) != fim - inicio + 1: return JSONResponse({"ok": False, "msg": "Parte incompleta."}, 400)
+    status, r = await run_in_threadpool(gravar_parte, sessao_id, inicio, total, corpo, request.headers.get('x-chunk-sha256'))
+    return JSONResponse(r, status)
+
+@app.post("/uploads/{sessao_id}/concluir")
+async def concluir_upload(sessao_id: str, sha256: str = Form("")):
+    status, r = await run_in_threadpool(concluir_sessao, sessao_id, sha256)
+    return JSONResponse(r, status)
+
+@app.delete("/uploads/{sessao_id}")
+async def cancelar_upload(sessao_id: str):
+    status, r = await run_in_threadpool(cancelar_sessao, sessao_id)
+    return JSONResponse(r, status)
+
+@app.get("/metrics")
+def metrics():
+    with _jobs_lock:
+        for tipo in JOB_LIMITES:
+            definir('nfe_jobs', len(_jobs_fila[tipo]), tipo=tipo, estado='fila')
+            definir('nfe_jobs', _jobs_rodando[tipo], tipo=tipo, estado='executando')
+    return PlainTextResponse(texto_metricas(), media_type="text/plain; version=0.0.4")
+
+@app.get("/download/{filename}")
+def download(filename: str):
+    path = os.path.join(REPORTS_DIR, filename)
+    if os.path.exists(path):
+        # Download conta como uso para a limpeza por LRU
+        s = SessionLocal()
+        try:
+            s.execute(update(CacheRelatorio).where(CacheRelatorio.filename == filename).values(ultimo_acesso=datetime.now()))
+            s.commit()
+        finally: s.close()
+        return FileResponse(path, filename=filename)
+    return JSONResponse({"msg": "Arquivo não encontrado"}, 404)
+
+# --- FRONTEND ---
+@app.get("/", response_class=HTMLResponse)
+async def home():
+    return """
+    <!DOCTYPE html>
+    <html lang="pt-br">
+    <head>
+        <meta charset="UTF-8">
+        <title>Extrator Fiscal V6</title>
+        <script src="https://cdn.tailwindcss.com"></script>
+        <script src="https://cdn.jsdelivr.net/npm/sweetalert2@11"></script>
+        <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css" rel="stylesheet">
+    </head>
+    <body class="bg-slate-50 min-h-screen text-slate-800 font-sans">
+        <div class="max-w-6xl mx-auto p-6 grid grid-cols-1 lg:grid-cols-3 gap-6">
+            
+            <div class="lg:col-span-2 space-y-6">
+                <div class="bg-white p-6 rounded-xl shadow border border-slate-200">
+                    <h2 class="text-xl font-bold text-blue-700 mb-4"><i class="fas fa-upload"></i> Importar Dados</h2>
+                    <div id="dropZone" class="border-2 border-dashed border-slate-300 rounded-lg p-10 text-center hover:bg-blue-50 hover:border-blue-400 transition cursor-pointer group">
+                        <i class="fas fa-file-archive text-5xl text-slate-300 group-hover:text-blue-500 mb-3 transition"></i>
+                        <p class="font-medium text-slate-600">Arraste múltiplos ZIPs aqui</p>
+                        <input type="file" id="fileInput" accept=".zip" multiple class="hidden">
+                    </div>
+                </div>
+
+                <div class="bg-white p-6 rounded-xl shadow border border-slate-200">
+                    <h2 class="text-xl font-bold text-green-700 mb-4"><i class="fas fa-filter"></i> Gerar Relatório</h2>
+                    <div class="grid grid-cols-1 md:grid-cols-2 gap-4 mb-4">
+                        <div>
+                            <label class="block text-sm font-bold text-slate-600 mb-1">Seu CNPJ (Opcional)</label>
+                            <input type="text" id="meuCnpj" placeholder="Números apenas" class="w-full border border-slate-300 rounded p-2 focus:ring focus:ring-blue-200 outline-none">
+                            <label class="block text-sm font-bold text-slate-600 mb-1 mt-3">Formato</label>
+                            <select id="formato" class="w-full border border-slate-300 rounded p-2 focus:ring focus:ring-blue-200 outline-none">
+                                <option value="xlsx">Excel (.xlsx)</option>
+                                <option value="csv">CSV (.csv)</option>
+                                <option value="parquet">Parquet (.parquet)</option>
+                            </select>
+                        </div>
+                        <div>
+                            <label class="block text-sm font-bold text-slate-600 mb-1">Anos Disponíveis</label>
+                            <div id="anosList" class="flex flex-wrap gap-2 text-sm">Carregando...</div>
+                        </div>
+                    </div>
+                    <details class="mb-4">
+                        <summary class="text-sm font-bold text-slate-600 cursor-pointer">Mais filtros</summary>
+                        <div class="grid grid-cols-2 md:grid-cols-3 gap-3 mt-3 text-sm">
+                            <div><label class="block text-slate-600 mb-1">Mês inicial</label><input type="month" id="mesDe" class="w-full border border-slate-300 rounded p-2"></div>
+                            <div><label class="block text-slate-600 mb-1">Mês final</label><input type="month" id="mesAte" class="w-full border border-slate-300 rounded p-2"></div>
+                            <div><label class="block text-slate-600 mb-1">UF Emitente</label><input id="uf" list="lista_uf" placeholder="SP,RJ" class="w-full border border-slate-300 rounded p-2"></div>
+                            <div><label class="block text-slate-600 mb-1">CNPJ Emitente</label><input id="cnpjEmitente" list="lista_emitente" class="w-full border border-slate-300 rounded p-2"></div>
+                            <div><label class="block text-slate-600 mb-1">CNPJ Destinatário</label><input id="cnpjDestinatario" list="lista_destinatario" class="w-full border border-slate-300 rounded p-2"></div>
+                            <div><label class="block text-slate-600 mb-1">CFOP</label><input id="cfop" list="lista_cfop" placeholder="5102 ou 5" class="w-full border border-slate-300 rounded p-2"></div>
+                            <div><label class="block text-slate-600 mb-1">NCM</label><input id="ncm" list="lista_ncm" placeholder="84713012 ou 8471" class="w-full border border-slate-300 rounded p-2"></div>
+                        </div>
+                        <datalist id="lista_emitente"></datalist><datalist id="lista_destinatario"></datalist>
+                        <datalist id="lista_cfop"></datalist><datalist id="lista_ncm"></datalist><datalist id="lista_uf"></datalist>
+                    </details>
+                    <button id="btnGerar" onclick="gerar()" disabled class="w-full bg-slate-300 text-white font-bold py-3 rounded-lg shadow transition">
+                        Selecione um ano
+                    </button>
+                </div>
+            </div>
+
+            <div class="bg-white p-6 rounded-xl shadow border border-slate-200 h-fit">
+                <h2 class="text-xl font-bold text-purple-700 mb-4"><i class="fas fa-history"></i> Relatórios Gerados</h2>
+                <div id="historicoList" class="space-y-2 max-h-[500px] overflow-y-auto pr-2">
+                    <div class="text-center text-slate-400 py-4"><i class="fas fa-circle-notch fa-spin"></i></div>
+                </div>
+                <button onclick="loadHistorico()" class="mt-4 text-sm text-blue-600 hover:underline w-full text-center"><i class="fas fa-sync"></i> Atualizar</button>
+            </div>
+        </div>
+
+        <script>
+            const dropZone = document.getElementById('dropZone');
+            const fileInput = document.getElementById('fileInput');
+            dropZone.onclick = () => fileInput.click();
+            fileInput.onchange = () => handleFiles(fileInput.files);
+            ['dragenter', 'dragover', 'dragleave', 'drop'].forEach(evt => {
+                dropZone.addEventListener(evt, e => { e.preventDefault(); e.stopPropagation(); });
+            });
+            dropZone.addEventListener('drop', e => handleFiles(e.dataTransfer.files));
+
+            async function handleFiles(files) {
+                let zips = Array.from(files).filter(f => f.name.toLowerCase().endsWith('.zip'));
+                if(!zips.length) return Swal.fire('Erro', 'Envie ZIPs.', 'error');
+                Swal.fire({title: 'Importando...', html: 'Enviando arquivos...', didOpen: () => Swal.showLoading()});
+                try {
+                    let msgs = [];
+                    for(let i=0; i<zips.length; i++) {
+                        let job = await enviarEmPartes(zips[i], pct => {
+                            Swal.update({html: `Enviando ${zips[i].name} (${i+1}/${zips.length}): ${pct.toFixed(0)}%`});
+                            Swal.showLoading();
+                        }, pct => {
+                            Swal.update({html: `Conferindo o que já foi enviado de ${zips[i].name} (${i+1}/${zips.length}): ${pct.toFixed(0)}%`});
+                            Swal.showLoading();
+                        });
+                        let data = await acompanharJob(job, p => `${zips[i].name}: ${p.arquivos || 0} XMLs lidos, ${p.itens || 0} itens gravados...`);
+                        if(!data.ok) return Swal.fire('Erro', data.msg, 'error');
+                        msgs.push(data.msg);
+                    }
+                    Swal.fire('Sucesso!', msgs.join('<br>'), 'success');
+                    loadFiltros();
+                } catch(e) { Swal.fire('Erro', e.message || 'Falha na conexão.', 'error'); }
+            }
+
+            // Upload em partes: a importação começa enquanto o arquivo ainda sobe. Se a conexão cair, retoma
+            // de onde o servidor parou (também depois de recarregar a página, pela sessão guardada no navegador).
+            const PARTE = 8 * 1024 * 1024;
+            // O sha256 do arquivo é calculado parte a parte enquanto ela sobe e vai ao concluir, quando o servidor confere;
+            // cada parte leva o seu (X-Chunk-Sha256) e é reenviada se chegar corrompida. Ao retomar, só o trecho já
+            // enviado é relido para o hash. Sem HTTPS o navegador não tem crypto.subtle: os hashes saem do Sha256 em JS.
+            async function enviarEmPartes(file, progresso, progressoHash) {
+                let chave = `upload:${file.name}:${file.size}:${file.lastModified}`;
+                let s = null;
+                if(localStorage[chave]) {
+                    let res = await fetch(`/uploads/${localStorage[chave]}`);
+                    if(res.ok) { s = await res.json(); if(s.status !== 'recebendo') s = null; }
+                }
+                if(!s) {
+                    let fd = new FormData();
+                    fd.append('nome', file.name);
+                    fd.append('tamanho', file.size);
+                    s = await (await fetch('/uploads', {method:'POST', body:fd})).json();
+                    if(!s.ok) throw new Error(s.msg);
+                    localStorage[chave] = s.id;
+                }
+                // h: sha256 de file[0, hpos). Acompanha o que o servidor já tem; se ele voltar atrás, recomeça do zero
+                let h = new Sha256(), hpos = 0;
+                async function alcancar(alvo, prog) {
+                    if(alvo < hpos) { h = new Sha256(); hpos = 0; }
+                    for(; hpos < alvo; hpos = Math.min(hpos + PARTE, alvo)) {
+                        if(prog) prog(100 * hpos / alvo);
+                        h.update(new Uint8Array(await file.slice(hpos, Math.min(hpos + PARTE, alvo)).arrayBuffer()));
+                    }
+                }
+                let pos = s.recebido, falhas = 0;
+                await alcancar(pos, progressoHash);
+                while(pos < file.size) {
+                    progresso(100 * pos / file.size);
+                    let dados = new Uint8Array(await file.slice(pos, Math.min(pos + PARTE, file.size)).arrayBuffer());
+                    let headers = {'Content-Range': `bytes ${pos}-${pos + dados.length - 1}/${file.size}`};
+                    headers['X-Chunk-Sha256'] = await sha256(dados);
+                    await alcancar(pos);
+                    // A parte entra no hash do arquivo enquanto sobe; se não for aceita inteira, volta ao estado anterior
+                    let antes = h.clone(), envio = fetch(`/uploads/${s.id}`, {method:'PUT', body:dados, headers});
+                    h.update(dados); hpos = pos + dados.length;
+                    let res;
+                    try { res = await envio; }
+                    catch(e) {
+                        h = antes; hpos = pos;
+                        // Rede caiu: espera e pergunta ao servidor quanto já chegou
+                        if(++falhas > 10) throw e;
+                        await new Promise(r => setTimeout(r, 2000 * falhas));
+                        try { pos = (await (await fetch(`/uploads/${s.id}`)).json()).recebido; } catch(e2) {}
+                        continue;
+                    }
+                    let r = await res.json();
+                    if(!res.ok || r.recebido !== hpos) { h = antes; hpos = pos; }
+                    if(res.ok || (res.status === 409 && r.recebido !== undefined)) { pos = r.recebido; falhas = 0; continue; }
+                    if(res.status === 400 && ++falhas <= 3) continue;  // parte corrompida no caminho: manda de novo
+                    throw new Error(r.msg);
+                }
+                progresso(100);
+                await alcancar(file.size, progressoHash);
+                let fd = new FormData();
+                fd.append('sha256', h.hex());
+                let r = await (await fetch(`/uploads/${s.id}/concluir`, {method:'POST', body:fd})).json();
+                if(!r.ok) throw new Error(r.msg);
+                delete localStorage[chave];
+                return r;
+            }
+
+            // SHA-256 incremental em JS puro: crypto.subtle só existe em HTTPS/localhost e não faz hash em partes
+            const K256 = new Uint32Array([
+                0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+                0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+                0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+                0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+                0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+                0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+                0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+                0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2]);
+            class Sha256 {
+                constructor() {
+                    this.h = new Uint32Array([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]);
+                    this.w = new Uint32Array(64);
+                    this.buf = new Uint8Array(64);
+                    this.n = 0;
+                    this.total = 0;
+                }
+                clone() {
+                    let c = new Sha256();
+                    c.h.set(this.h); c.buf.set(this.buf); c.n = this.n; c.total = this.total;
+                    return c;
+                }
+                update(d) {
+                    let i = 0;
+                    this.total += d.length;
+                    if(this.n) {
+                        i = Math.min(64 - this.n, d.length);
+                        this.buf.set(d.subarray(0, i), this.n);
+                        this.n += i;
+                        if(this.n < 64) return this;
+                        this.bloco(this.buf, 0);
+                        this.n = 0;
+                    }
+                    for(; i + 64 <= d.length; i += 64) this.bloco(d, i);
+                    this.buf.set(d.subarray(i), 0);
+                    this.n = d.length - i;
+                    return this;
+                }
+                bloco(d, o) {
+                    const w = this.w, h = this.h;
+                    for(let t = 0; t < 16; t++, o += 4) w[t] = (d[o] << 24) | (d[o+1] << 16) | (d[o+2] << 8) | d[o+3];
+                    for(let t = 16; t < 64; t++) {
+                        let x = w[t-15], y = w[t-2];
+                        let s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3);
+                        let s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10);
+                        w[t] = w[t-16] + s0 + w[t-7] + s1;
+                    }
+                    let a = h[0], b = h[1], c = h[2], e = h[4], f = h[5], g = h[6], dd = h[3], hh = h[7];
+                    for(let t = 0; t < 64; t++) {
+                        let s1 = ((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7));
+                        let t1 = (hh + s1 + ((e & f) ^ (~e & g)) + K256[t] + w[t]) | 0;
+                        let s0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+                        let t2 = (s0 + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+                        hh = g; g = f; f = e; e = (dd + t1) | 0; dd = c; c = b; b = a; a = (t1 + t2) | 0;
+                    }
+                    h[0] += a; h[1] += b; h[2] += c; h[3] += dd; h[4] += e; h[5] += f; h[6] += g; h[7] += hh;
+                }
+                hex() {
+                    let bits = this.total * 8, pad = new Uint8Array((this.n < 56 ? 64 : 128) - this.n), L = pad.length;
+                    pad[0] = 0x80;
+                    for(let i = 0, hi = Math.floor(bits / 4294967296), lo = bits >>> 0; i < 4; i++) {
+                        pad[L-8+i] = (hi >>> (24 - 8*i)) & 255;
+                        pad[L-4+i] = (lo >>> (24 - 8*i)) & 255;
+                    }
+                    this.update(pad);
+                    return Array.from(this.h, x => x.toString(16).padStart(8, '0')).join('');
+                }
+            }
+
+            async function sha256(dados) {
+                if(crypto.subtle) {
+                    let h = await crypto.subtle.digest('SHA-256', dados);
+                    return Array.from(new Uint8Array(h)).map(b => b.toString(16).padStart(2, '0')).join('');
+                }
+                return new Sha256().update(dados).hex();
+            }
+
+            // Consulta o job até terminar, mostrando o progresso no modal
+            async function acompanharJob(job, texto) {
+                if(!job.ok) return job;
+                while(true) {
+                    await new Promise(r => setTimeout(r, 1000));
+                    let res = await fetch(`/jobs/${job.job_id}`);
+                    let st = await res.json();
+                    if(st.status === 'concluido') return st.resultado;
+                    if(st.status === 'erro') return {ok: false, msg: st.erro};
+                    Swal.update({html: texto(st.progresso)});
+                    Swal.showLoading();
+                }
+            }
+
+            async function loadFiltros() {
+                let res = await fetch('/filtros');
+                let data = await res.json();
+                let div = document.getElementById('anosList');
+                div.innerHTML = '';
+                if(data.anos.length === 0) div.innerHTML = 'Nenhum dado.';
+                data.anos.forEach(ano => {
+                    div.innerHTML += `<label class="cursor-pointer select-none"><input type="checkbox" value="${ano}" onchange="checkBtn(); loadFacetas()" class="peer sr-only"><span class="px-3 py-1 rounded bg-slate-100 border text-slate-500 peer-checked:bg-green-600 peer-checked:text-white peer-checked:border-green-600 transition text-xs font-bold">${ano}</span></label>`;
+                });
+                preencherFacetas(data);
+            }
+
+            // Sugestões dos filtros (com contagem de notas) para os anos marcados
+            async function loadFacetas() {
+                let res = await fetch('/filtros?anos=' + encodeURIComponent(anosMarcados()));
+                preencherFacetas(await res.json());
+            }
+
+            function preencherFacetas(data) {
+                // Valor e descrição vêm dos XMLs enviados: entram como texto pelo DOM, nunca como HTML
+                ['emitente', 'destinatario', 'cfop', 'ncm', 'uf'].forEach(dim => {
+                    document.getElementById('lista_' + dim).replaceChildren(...(data[dim] || []).map(f => {
+                        let op = document.createElement('option');
+                        op.value = f.valor;
+                        op.textContent = `${f.descricao ? f.descricao + ' - ' : ''}${f.qtd_notas} notas`;
+                        return op;
+                    }));
+                });
+            }
+
+            function anosMarcados() {
+                return Array.from(document.querySelectorAll('input[type="checkbox"]:checked')).map(x => x.value).join(',');
+            }
+
+            async function loadHistorico() {
+                let div = document.getElementById('historicoList');
+                try {
+                    let res = await fetch('/historico');
+                    let data = await res.json();
+                    div.innerHTML = '';
+                    if(data.arquivos.length === 0) { div.innerHTML = '<div class="text-sm text-slate-400 text-center">Nenhum relatório.</div>'; return; }
+                    data.arquivos.forEach(file => {
+                        div.innerHTML += `<div class="flex items-center justify-between p-3 bg-slate-50 rounded hover:bg-blue-50 border border-slate-100 transition group"><div><div class="text-sm font-bold text-slate-700 truncate w-40" title="${file.nome}">${file.nome}</div><div class="text-xs text-slate-400">${file.data}</div></div><a href="/download/${file.nome}" class="text-blue-500 hover:text-blue-700 bg-white p-2 rounded-full shadow-sm"><i class="fas fa-download"></i></a></div>`;
+                    });
+                } catch(e) { div.innerHTML = 'Erro ao carregar.'; }
+            }
+
+            function checkBtn() {
+                let count = document.querySelectorAll('input[type="checkbox"]:checked').length;
+                let btn = document.getElementById('btnGerar');
+                if(count > 0) {
+                    btn.disabled = false;
+                    btn.className = "w-full bg-green-600 hover:bg-green-700 text-white font-bold py-3 rounded-lg shadow transition transform active:scale-95";
+                    btn.innerText = "Gerar Relatório";
+                } else {
+                    btn.disabled = true;
+                    btn.className = "w-full bg-slate-300 text-white font-bold py-3 rounded-lg shadow transition cursor-not-allowed";
+                    btn.innerText = "Selecione um ano";
+                }
+            }
+
+            async function gerar() {
+                let cnpj = document.getElementById('meuCnpj').value;
+                Swal.fire({title: 'Gerando...', html: 'Criando relatório...', didOpen: () => Swal.showLoading()});
+                let fd = new FormData();
+                fd.append('anos', anosMarcados());
+                fd.append('meu_cnpj', cnpj);
+                fd.append('formato', document.getElementById('formato').value);
+                [['mes_de', 'mesDe'], ['mes_ate', 'mesAte'], ['cnpj_emitente', 'cnpjEmitente'], ['cnpj_destinatario', 'cnpjDestinatario'],
+                 ['cfop', 'cfop'], ['ncm', 'ncm'], ['uf', 'uf']].forEach(([campo, id]) => fd.append(campo, document.getElementById(id).value));
+                try {
+                    let res = await fetch('/jobs/gerar', {method:'POST', body:fd});
+                    let data = await acompanharJob(await res.json(), p => `${p.linhas || 0} linhas gravadas...`);
+                    if(data.ok) {
+                        loadHistorico();
+                        Swal.fire({
+                            title: 'Sucesso!',
+                            icon: 'success',
+                            html: `<div class="bg-slate-100 p-3 rounded text-left text-sm space-y-2 mb-4"><div class="flex justify-between border-b pb-1"><span>Total Notas:</span> <span class="font-bold text-green-700">${data.notas}</span></div><div class="flex justify-between border-b pb-1"><span>Total Itens:</span> <span class="font-bold text-blue-700">${data.itens}</span></div><div class="text-center font-bold text-slate-600 pt-1">${data.resumo_ops}</div></div>`,
+                            confirmButtonText: 'Baixar',
+                            showCancelButton: true,
+                            cancelButtonText: 'Fechar'
+                        }).then((result) => { if(result.isConfirmed) window.location.href = data.url; });
+                    } else { Swal.fire('Erro', data.msg, 'error'); }
+                } catch(e) { Swal.fire('Erro', 'Falha ao processar.', 'error'); }
+            }
+            loadFiltros();
+            loadHistorico();
+        </script>
+    </body>
+    </html>
+    """
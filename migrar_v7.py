@@ -0,0 +1,55 @@
+"""Migra os itens da tabela antiga notas_fiscais_v6 (dados_json) para a notas_fiscais_v7 (colunas tipadas).
+
+Lê a tabela antiga em lotes pela chave primária e grava com o mesmo upsert da importação,
+então pode ser interrompido e executado de novo sem duplicar nada.
+
+Uso: python migrar_v7.py [tamanho_lote]
+"""
+import ast
+import sys
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, inspect, select
+
+from main import engine, SessionLocal, CAMPOS_RELATORIO, DB_BATCH_SIZE, gravar_lote, reconstruir_resumos
+
+TABELA_ANTIGA = "notas_fiscais_v6"
+
+def converter(r):
+    # dados_json guarda o repr() do dicionário: literal_eval em vez de eval
+    row = ast.literal_eval(r.dados_json)
+    valores = []
+    for c, rotulo in CAMPOS_RELATORIO:
+        v = row.get(rotulo, "")
+        if c == 'data_nfe': v = datetime.strptime(v, '%d/%m/%Y').date() if v else None
+        valores.append(v)
+    return (r.chave_item, *valores, r.cnpj_destinatario or "")
+
+def migrar(tamanho_lote=DB_BATCH_SIZE):
+    if not inspect(engine).has_table(TABELA_ANTIGA):
+        print(f"Tabela {TABELA_ANTIGA} não existe, nada a migrar.")
+        return 0
+    antiga = Table(TABELA_ANTIGA, MetaData(), autoload_with=engine)
+    sess = SessionLocal()
+    total, ultima = 0, None
+    try:
+        while True:
+            q = select(antiga.c.chave_item, antiga.c.cnpj_destinatario, antiga.c.dados_json) \
+                .order_by(antiga.c.chave_item).limit(tamanho_lote)
+            if ultima is not None: q = q.where(antiga.c.chave_item > ultima)
+            lote = sess.execute(q).all()
+            if not lote: break
+            gravar_lote(sess, [converter(r) for r in lote])
+            sess.commit()
+            total += len(lote)
+            ultima = lote[-1].chave_item
+            print(f"{total} itens migrados...")
+        # Resumos por nota/mês a partir dos itens migrados
+        reconstruir_resumos(sess)
+    finally:
+        sess.close()
+    print(f"Concluído: {total} itens migrados para a v7.")
+    return total
+
+if __name__ == "__main__":
+    migrar(int(sys.argv[1]) if len(sys.argv) > 1 else DB_BATCH_SIZE)